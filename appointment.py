@@ -1,13 +1,33 @@
 import datetime
+import functools
 import re
 from collections import OrderedDict
 
-import pytz
-
-from typing import List, NamedTuple, Optional
+from typing import List, NamedTuple, Optional, Tuple
 
+import availability
+import clock
 import db
 import exceptions
+import render
+import settings
+import tenants
+
+_settings_caches = tenants.TenantResource(lambda tenant: settings.SettingsCache())
+_indexes = tenants.TenantResource(lambda tenant: _load_index())
+
+
+def _load_index() -> availability.AvailabilityIndex:
+    index = availability.AvailabilityIndex()
+    index.load()
+    return index
+
+
+def _synced_index() -> availability.AvailabilityIndex:
+    """The index for reading, up to date with the writes of other processes"""
+    index = _indexes.get()
+    index.sync()
+    return index
 
 
 class Message(NamedTuple):
@@ -25,10 +45,18 @@ class DayFormat(NamedTuple):
 class Timeline(NamedTuple):
     """Structure of new sessions added to the db"""
     session_date: datetime.date
-    session_time: str
     available: bool
     raw_text: str
     session_times: list
+    duplicate_times: list
+
+
+class Reminder(NamedTuple):
+    """Structure of a reminder that is due to be sent"""
+    id: int
+    user_id: int
+    kind: str
+    session_time: str
 
 
 class DaysPlan(NamedTuple):
@@ -37,34 +65,77 @@ class DaysPlan(NamedTuple):
     days_times: dict
 
 
-def add_sessions(raw_message: str):
+def add_sessions(raw_message: str) -> List[Timeline]:
     """Adds sessions.
-    Takes as input the text of the message that came to the bot."""
-    parsed_message = _parse_message(raw_message)
-    session_date = parsed_message.date
-    session_times = parsed_message.sessions
-
-    for session in session_times:
-        if len(session) in (1, 2):
-            time_session = datetime.time(int(session), 0, 0)
-        elif ':' in session:
-            session = session.split(':')
-            time_session = datetime.time(int(session[0]), int(session[1]), 0)
-        inserted_row_id = db.insert({
-            "session_date": str(session_date),
-            "session_time": str(time_session),
-            "available": True,
-            "raw_text": raw_message,
-            "created": _get_now_formatted()
-        })
-
-    return Timeline(
-                    session_date=session_date,
-                    session_time=str(time_session),
-                    available=True,
-                    raw_text=raw_message,
-                    session_times=session_times
-                    )
+    Takes as input the text of the message that came to the bot,
+    one day per line. All sessions are inserted in one transaction,
+    the ones that are already in the timeline or earlier in the
+    message are skipped."""
+    parsed_messages = _parse_schedule(raw_message)
+    created = _get_now_formatted()
+    rows = {}
+    for parsed_message in parsed_messages:
+        session_date = parsed_message.date
+        for session in parsed_message.sessions:
+            time_session = _parse_session_time(session)
+            session_start = clock.to_epoch(session_date, time_session)
+            rows.setdefault(session_start, {
+                "session_date": str(session_date),
+                "session_time": str(time_session),
+                "session_start": session_start,
+                "available": True,
+                "raw_text": raw_message,
+                "created": created
+            })
+    inserted_ids, duplicates, change = db.insert_sessions(list(rows.values()))
+    duplicates = set(duplicates)
+    inserted_rows = [row for row in rows.values() if row["session_start"] not in duplicates]
+    index = _indexes.get()
+    index.apply(change, functools.partial(index.add, [
+        availability.Slot(session_id, row["session_date"], row["session_time"],
+                          row["session_start"], True, None, None, None, None)
+        for session_id, row in zip(inserted_ids, inserted_rows)
+    ]))
+
+    result = []
+    listed = set()
+    for parsed_message in parsed_messages:
+        session_date = parsed_message.date
+        opened, duplicate_times = [], []
+        for session in parsed_message.sessions:
+            session_start = clock.to_epoch(session_date, _parse_session_time(session))
+            if session_start in duplicates or session_start in listed:
+                duplicate_times.append(session)
+            else:
+                opened.append(session)
+            listed.add(session_start)
+        result.append(Timeline(
+            session_date=session_date,
+            available=True,
+            raw_text=raw_message,
+            session_times=opened,
+            duplicate_times=duplicate_times
+        ))
+    return result
+
+
+def _parse_session_time(session: str) -> datetime.time:
+    if ':' in session:
+        session = session.split(':')
+        return datetime.time(int(session[0]), int(session[1]), 0)
+    return datetime.time(int(session), 0, 0)
+
+
+def _parse_schedule(raw_message: str) -> List[Message]:
+    """Parses a message with one day of sessions per line"""
+    lines = [line for line in raw_message.splitlines() if line.strip()]
+    if not lines:
+        raise exceptions.NotCorrectMessage(
+            "I can't understand the message. Write a message in the format, "
+            "for example:\n05.04 10 12 13:30"
+            "\nWhere 05.04 is the date, then the time of the sessions, "
+            "separated by a space.")
+    return [_parse_message(line) for line in lines]
 
 
 def _parse_message(raw_message: str):
@@ -84,9 +155,9 @@ def _parse_message(raw_message: str):
 
     session_date = regexp_result.group(1).split('.')
     session_times = regexp_result.group(2).split(' ')
-    now_date = str(get_now_datetime()).split()[0].split('-')
+    now_date = get_now_datetime().date()
     try:
-        day_session = datetime.date(int(get_now_datetime().year),
+        day_session = datetime.date(now_date.year,
                                     int(session_date[1]),
                                     int(session_date[0]))
     except ValueError:
@@ -120,12 +191,12 @@ def _parse_message(raw_message: str):
                     'then the time of the sessions, separated by a space.'
                 )
 
-    delta = day_session - datetime.date(int(now_date[0]), int(now_date[1]), int(now_date[2]))
+    delta = day_session - now_date
     if delta.days >= 0:
-        session_date.append(str(get_now_datetime().year))
+        session_date.append(str(now_date.year))
 
     elif delta.days < 0:
-        session_date.append(str(int(get_now_datetime().year) + 1))
+        session_date.append(str(now_date.year + 1))
 
     session_date = datetime.date(int(session_date[2]), int(session_date[1]), int(session_date[0]))
     return Message(date=session_date, sessions=session_times)
@@ -133,88 +204,95 @@ def _parse_message(raw_message: str):
 
 def create_sessions(raw_text) -> str:
     try:
-        session = add_sessions(raw_text)
+        sessions = add_sessions(raw_text)
     except exceptions.NotCorrectMessage as e:
         message_answer = str(e)
         return message_answer
-    about_day = day_format(str(session.session_date))
-    message_answer = \
-        f'For {about_day.day_of_week} <b>{about_day.date}</b> ' \
-        f'the sessions are open at hours: {session.session_times}'
-    return message_answer
+    answers = []
+    for session in sessions:
+        about_day = day_format(str(session.session_date))
+        message_answer = \
+            f'For {about_day.day_of_week} <b>{about_day.date}</b> ' \
+            f'the sessions are open at hours: {session.session_times}'
+        if session.duplicate_times:
+            message_answer += \
+                f'\nAlready in the timeline: {session.duplicate_times}'
+        answers.append(message_answer)
+    return '\n\n'.join(answers)
 
 
 def get_all_sessions():
-    cursor = db.get_cursor()
-    cursor.execute("SELECT session_date, id, available, session_time, "
-                   "customer_name, customer_username, updated, customer_user_id "
-                   "FROM timeline "
-                   "ORDER BY session_date, session_time ")
-    result = cursor.fetchall()
-    if not result:
+    sessions = _synced_index().all_sessions()
+    if not sessions:
         return False
     result_dict = OrderedDict()
-    for session in result:
-        if session[2] == 1:
-            if session[0] not in result_dict:
-                result_dict[session[0]] = [(session[1], '✔️',
-                                           session[3], '',
-                                           '', '', '')]
-            else:
-                result_dict[session[0]].append((session[1], '✔️',
-                                                session[3], '',
-                                                '', '', ''))
-        elif session[2] == 0:
-            if session[0] not in result_dict:
-                result_dict[session[0]] = [(session[1], '✖️',
-                                           session[3], session[4],
-                                           f"@{session[5]}", session[6], session[7])]
-            else:
-                result_dict[session[0]].append((session[1], '✖️',
-                                                session[3], session[4],
-                                                f"@{session[5]}", session[6], session[7]))
-
+    for day, slots in sessions.items():
+        result_dict[day] = [
+            (slot.id, '✔️', slot.session_time, '', '', '', '') if slot.available else
+            (slot.id, '✖️', slot.session_time, slot.customer_name,
+             f"@{slot.customer_username}", slot.updated, slot.customer_user_id)
+            for slot in slots
+        ]
     return result_dict
 
 
 def get_timeline() -> str:
-    """Returns the timeline in string format for view in bot"""
+    """Returns the timeline in string format for view in bot.
+    The text of every day is cached until the day changes."""
+    versions = get_day_versions()
     sessions = get_all_sessions()
     if sessions:
-        message_answer = ''
-        for day, times in sessions.items():
-            about_day = day_format(day)
-            message_answer += \
-                f'\n\n{about_day.day_of_week} <b>{about_day.date}</b>\n\n'
-            for time in times:
-                message_answer += \
-                    f'{time[1]} {time[2][:5]} {time[3]} {time[4]} {time[5][5:-3]}\n'
-                # available, session_time, customer_name, customer_username, updated
+        cache = render.get_cache()
+        cache.retain(versions)
+        message_answer = ''.join(
+            cache.get('timeline', day, versions.get(day),
+                      functools.partial(_render_timeline_day, day, times))
+            for day, times in sessions.items())
     else:
         message_answer = \
             'Timeline is empty 👾'
     return message_answer
 
 
+def _render_timeline_day(day: str, times: list) -> str:
+    about_day = day_format(day)
+    lines = [f'\n\n{about_day.day_of_week} <b>{about_day.date}</b>\n\n']
+    for time in times:
+        lines.append(f'{time[1]} {time[2][:5]} {time[3]} {time[4]} {time[5][5:-3]}\n')
+        # available, session_time, customer_name, customer_username, updated
+    return ''.join(lines)
+
+
+def get_day_versions() -> dict:
+    """Data version of every day, for caching what is rendered from the day.
+    Read it before the sessions it's used with."""
+    return _synced_index().day_versions()
+
+
+@functools.lru_cache(maxsize=512)
 def day_format(day: str):
-    date_day = day.split('-')
-    date_day = datetime.date(int(date_day[0]), int(date_day[1]), int(date_day[2]))
+    date_day = datetime.date.fromisoformat(day)
     view_date = date_day.strftime("%d.%m.%Y")
     day_of_week = date_day.strftime("%A")
     return DayFormat(date=view_date, day_of_week=day_of_week)
 
 
-def delete_session(session_id: int) -> None:
-    db.delete_session(session_id)
+def delete_session(session_id: int, notifications: db.Notifications = ()) -> None:
+    change = db.delete_session(session_id, notifications)
+    index = _indexes.get()
+    index.apply(change, functools.partial(index.remove, session_id))
 
 
-def delete_day(day: str) -> None:
-    db.delete_day(day)
+def delete_day(day: str, notifications: db.Notifications = ()) -> None:
+    change = db.delete_day(day, notifications)
+    index = _indexes.get()
+    index.apply(change, functools.partial(index.remove_day, day))
 
 
 def change_info(raw_message: str) -> None:
     parsed_message = _parse_message_info(raw_message)
     db.update_info(parsed_message)
+    _settings_caches.get().invalidate()
 
 
 def _parse_message_info(raw_message: str) -> str:
@@ -232,6 +310,7 @@ def change_price(raw_message: str):
     parsed_message = _parse_message_price(raw_message)
     price1, price2, price3 = parsed_message
     db.update_price(price1, price2, price3)
+    _settings_caches.get().invalidate()
 
 
 def _parse_message_price(raw_message: str) -> tuple:
@@ -248,6 +327,7 @@ def _parse_message_price(raw_message: str) -> tuple:
 def change_address(raw_message: str) -> None:
     parsed_message = _parse_message_address(raw_message)
     db.update_address(parsed_message)
+    _settings_caches.get().invalidate()
 
 
 def _parse_message_address(raw_message: str) -> str:
@@ -261,79 +341,141 @@ def _parse_message_address(raw_message: str) -> str:
     result_message = ' '.join(split_message[1:])
     return result_message
 
-def get_available_sessions():
-    cursor = db.get_cursor()
-    cursor.execute("SELECT session_date, session_time, id "
-                   f"FROM timeline WHERE available={True} ORDER BY session_date, session_time")
-    result = cursor.fetchall()
-    if not result:
+def get_available_sessions(user_id: Optional[int] = None):
+    """Available sessions by day, without the ones held for other clients"""
+    sessions = _synced_index().available_sessions(clock.now_epoch(), user_id)
+    if not sessions:
         return False
-    result_dict = OrderedDict()
-    for session in result:
-        if session[0] not in result_dict:
-            result_dict[session[0]] = [(session[1], session[2])]
-        else:
-            result_dict[session[0]].append((session[1], session[2]))
-    return result_dict
+    return OrderedDict((day, [(slot.session_time, slot.id) for slot in slots])
+                       for day, slots in sessions.items())
+
+
+def join_waitlist(user_id: int, raw_day: str) -> bool:
+    """Puts the client on the waitlist of the DD.MM day, or of any session
+    when raw_day is empty. False if they are already waiting for it."""
+    day = _parse_waitlist_day(raw_day)
+    available = get_available_sessions(user_id)
+    if available and (day is None or day in available):
+        raise exceptions.NotCorrectMessage("There are free sessions, book one with /book_session")
+    return db.join_waitlist(user_id, day)
+
+
+def _parse_waitlist_day(raw_day: str) -> Optional[str]:
+    if not raw_day.strip():
+        return None
+    regexp_result = re.fullmatch(r"(\d{2})\.(\d{2})", raw_day.strip())
+    today = get_now_datetime().date()
+    try:
+        day = datetime.date(today.year, int(regexp_result.group(2)), int(regexp_result.group(1)))
+        # a day that has passed this year is next year's, as with new sessions
+        if day < today:
+            day = day.replace(year=today.year + 1)
+    except (AttributeError, ValueError):
+        day = None
+    if day is None:
+        raise exceptions.NotCorrectMessage(
+            "Write /waitlist to wait for any session, or /waitlist with a day, "
+            "for example: /waitlist 05.04. /waitlist leave takes you off the waitlist.")
+    return day.isoformat()
+
+
+def leave_waitlist(user_id: int) -> int:
+    count, change = db.leave_waitlist(user_id)
+    _indexes.get().apply(change)
+    return count
+
+
+def expire_holds() -> Tuple[int, Optional[int]]:
+    """Passes the sessions whose hold lapsed to the next clients on the
+    waitlist. Returns the number of lapsed holds and when the next hold
+    lapses, None without holds. While the loaded index has no lapsed hold
+    the database isn't written."""
+    now = clock.now_epoch()
+    index = _indexes.peek()
+    if index is not None:
+        index.sync()
+        next_expiry = index.next_hold_expiry()
+        if next_expiry is None or next_expiry > now:
+            return 0, next_expiry
+    lapsed, change, next_expiry = db.expire_holds(now)
+    if index is not None:
+        index.apply(change)
+    return lapsed, next_expiry
 
 
 def get_about() -> str:
-    cursor = db.get_cursor()
-    cursor.execute("SELECT about_master FROM about")
-    result = cursor.fetchone()[0]
-    return result
+    return _settings_caches.get().get().about_master
 
 
 def get_address() -> str:
-    cursor = db.get_cursor()
-    cursor.execute("SELECT raw_address FROM about")
-    result = cursor.fetchone()[0]
-    return result
+    return _settings_caches.get().get().raw_address
 
 
 def get_price() -> tuple:
-    cursor = db.get_cursor()
-    cursor.execute("SELECT price1, price2, price3 FROM about")
-    return cursor.fetchone()
+    cached = _settings_caches.get().get()
+    return cached.price1, cached.price2, cached.price3
+
+
+def get_settings() -> settings.Settings:
+    return _settings_caches.get().get()
+
+
+def get_timeline_version() -> tuple:
+    """Data version of the whole timeline, changes whenever a session does.
+    Read it before the sessions it's used with."""
+    index = _synced_index()
+    return index.generation, index.version
+
+
+def get_timeline_slots() -> "OrderedDict[str, List[availability.Slot]]":
+    """All sessions of the timeline by day"""
+    return _synced_index().all_sessions()
+
+
+def get_client_session(user_id: int) -> Optional[availability.Slot]:
+    return _synced_index().client_session(user_id)
 
 
 def booking_session(session_id: int, user_id: int,
-                    username: str, user_fullname: str) -> None:
-    db.booking(session_id, user_id, username,
-               user_fullname, _get_now_formatted())
+                    username: str, user_fullname: str,
+                    by_admin: bool = False, notifications: db.Notifications = ()) -> list:
+    """Books the session, returns the (id, due time) of its reminders.
+    Raises SessionTaken if the session is not available anymore
+    and AlreadyBooked if the client already has a session."""
+    booking_time = _get_now_formatted()
+    reminders, change = db.booking(session_id, user_id, username,
+                                   user_fullname, booking_time, by_admin, notifications)
+    index = _indexes.get()
+    index.apply(change, functools.partial(index.book, session_id, user_id, username,
+                                          user_fullname, booking_time))
+    return reminders
+
 
+def cancel_session(session_id: int, notifications: db.Notifications = ()) -> None:
+    change = db.reset_session(session_id, notifications)
+    index = _indexes.get()
+    index.apply(change, functools.partial(index.reset, session_id))
 
-def cancel_session(session_id: int) -> None:
-    db.reset_session(session_id)
+
+def get_session(session_id: int) -> Optional[availability.Slot]:
+    return _synced_index().get(session_id)
 
 
 def check_client_in_db(user_id: int):
-    cursor = db.get_cursor()
-    cursor.execute(f"SELECT id, session_date, session_time "
-                   f"FROM timeline "
-                   f"WHERE customer_user_id={user_id}")
-    result = cursor.fetchall()
-    if result:
-        return result[0]
+    slot = _synced_index().client_session(user_id)
+    if slot:
+        return slot.id, slot.session_date, slot.session_time
     return False
 
 
 def get_booked_sessions():
-    cursor = db.get_cursor()
-    cursor.execute(f"SELECT id, session_date, "
-                   f"session_time, customer_user_id, "
-                   f"customer_username "
-                   f"FROM timeline WHERE available={False} "
-                   f"ORDER BY session_date, session_time")
-    result = cursor.fetchall()
-    if not result:
+    sessions = _synced_index().booked_sessions()
+    if not sessions:
         return False
     result_dict = OrderedDict()
-    for session in result:
-        if session[1] not in result_dict:
-            result_dict[session[1]] = [(session[0], session[2], session[3], session[4])]
-        else:
-            result_dict[session[1]].append((session[0], session[2], session[3], session[4]))
+    for day, slots in sessions.items():
+        result_dict[day] = [(slot.id, slot.session_time, slot.customer_user_id,
+                             slot.customer_username) for slot in slots]
     return result_dict
 
 
@@ -344,23 +486,45 @@ def _get_now_formatted() -> str:
 
 def get_now_datetime() -> datetime.datetime:
     """Returns today datetime with Warsaw timezone."""
-    tz = pytz.timezone("Europe/Warsaw")
-    now = datetime.datetime.now(tz)
-    return now
-
-
-def refresh_db() -> None:
-    sessions = get_all_sessions()
-    if sessions:
-        for day, times in sessions.items():
-            day_split = day.split('-')
-            year, month, day = int(day_split[0]), int(day_split[1]), int(day_split[2])
-            for time in times:
-                session_id = int(time[0])
-                time_split = time[2].split(':')
-                hours, minutes, seconds = int(time_split[0]), int(time_split[1]), int(time_split[2])
-                session_datetime = datetime.datetime(year, month, day, hours, minutes, seconds)
-                delta = session_datetime - datetime.datetime.now()
-                if delta.days < 0:
-                    delete_session(session_id)
-
+    return clock.now()
+
+
+def get_pending_reminders() -> list:
+    """(due time, id) of all reminders that are not sent yet"""
+    with db.read_connection() as conn:
+        return conn.execute(
+            "SELECT due_at, id FROM reminders WHERE sent=0").fetchall()
+
+
+def take_reminder(reminder_id: int) -> Optional[Reminder]:
+    """Claims the reminder for sending.
+    None if it was already sent or its session was cancelled"""
+    if not db.claim_reminder(reminder_id):
+        return None
+    with db.read_connection() as conn:
+        row = conn.execute(
+            "SELECT reminders.id, reminders.user_id, reminders.kind, timeline.session_time "
+            "FROM reminders JOIN timeline ON timeline.id = reminders.session_id "
+            "WHERE reminders.id=?", (reminder_id,)).fetchone()
+    if not row:
+        return None
+    return Reminder(*row)
+
+
+def refresh_db() -> int:
+    """Archives the sessions that have already started,
+    returns how many were moved"""
+    now = clock.now()
+    now_epoch = int(now.timestamp())
+    today = now.date().isoformat()
+    archived, change = db.archive_past_sessions(now_epoch)
+    # an idle tenant doesn't need its index loaded for this
+    index = _indexes.peek()
+    if index is not None:
+        index.apply(change, functools.partial(index.remove_before, now_epoch, today))
+    return archived
+
+
+def check_index() -> List[int]:
+    """Ids of the sessions where the in-memory index and the database differ"""
+    return _indexes.get().check_consistency()
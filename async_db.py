@@ -0,0 +1,74 @@
+"""Awaitable access to the database.
+
+The functions of db.py and appointment.py talk to sqlite3 synchronously.
+Here they are run on a pool of worker threads, so that a slow query or
+commit doesn't block the aiogram event loop. Readers take their own
+connection from db.read_connection(), writers are serialized by
+db.write_connection(). The calls run in a copy of the caller's context,
+so they work on the caller's tenant."""
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import appointment
+import db
+import export
+import ical
+import stats
+
+_executor = ThreadPoolExecutor(max_workers=db.READ_POOL_SIZE + 1,
+                               thread_name_prefix="db")
+
+
+async def run(func, *args, **kwargs):
+    """Runs a blocking function on a database worker thread"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def _awaitable(func):
+    """Makes an awaitable version of the blocking function"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+# db.py
+claim_outbox = _awaitable(db.claim_outbox)
+finish_outbox = _awaitable(db.finish_outbox)
+next_outbox_attempt = _awaitable(db.next_outbox_attempt)
+
+# appointment.py
+create_sessions = _awaitable(appointment.create_sessions)
+get_all_sessions = _awaitable(appointment.get_all_sessions)
+get_timeline = _awaitable(appointment.get_timeline)
+get_day_versions = _awaitable(appointment.get_day_versions)
+delete_session = _awaitable(appointment.delete_session)
+delete_day = _awaitable(appointment.delete_day)
+change_info = _awaitable(appointment.change_info)
+change_price = _awaitable(appointment.change_price)
+change_address = _awaitable(appointment.change_address)
+get_available_sessions = _awaitable(appointment.get_available_sessions)
+get_about = _awaitable(appointment.get_about)
+get_address = _awaitable(appointment.get_address)
+get_price = _awaitable(appointment.get_price)
+booking_session = _awaitable(appointment.booking_session)
+cancel_session = _awaitable(appointment.cancel_session)
+get_session = _awaitable(appointment.get_session)
+check_client_in_db = _awaitable(appointment.check_client_in_db)
+get_booked_sessions = _awaitable(appointment.get_booked_sessions)
+get_pending_reminders = _awaitable(appointment.get_pending_reminders)
+take_reminder = _awaitable(appointment.take_reminder)
+refresh_db = _awaitable(appointment.refresh_db)
+join_waitlist = _awaitable(appointment.join_waitlist)
+leave_waitlist = _awaitable(appointment.leave_waitlist)
+expire_holds = _awaitable(appointment.expire_holds)
+stats_report = _awaitable(stats.report)
+export_sessions = _awaitable(export.export)
+master_feed = _awaitable(ical.master_feed)
+client_feed = _awaitable(ical.client_feed)
@@ -0,0 +1,274 @@
+"""In-memory index of the timeline.
+
+Built once from the database at startup and then updated in place by the
+write paths of appointment.py, so listing available and booked sessions
+and finding the session of a client don't run any SQL. The holds of the
+waitlist are kept too, the available sessions leave out the ones held for
+other clients. A write is applied
+to the index after its commit, so readers of the index don't wait for the
+database; db.Change numbers the writes and apply() keeps them in order.
+Other processes may share the database: sync() loads the index again
+when one of them wrote to the timeline, and so does apply() when such a
+write came before its own. check_consistency() compares the index with
+the database."""
+
+import bisect
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import db
+
+
+class Slot(NamedTuple):
+    """Structure of a timeline row kept in the index"""
+    id: int
+    session_date: str
+    session_time: str
+    session_start: int
+    available: bool
+    customer_user_id: Optional[int]
+    customer_username: Optional[str]
+    customer_name: Optional[str]
+    updated: Optional[str]
+
+
+_generations = itertools.count(1)
+
+# seconds apply() waits for the writes before its own to be applied,
+# after that the index is loaded again
+APPLY_TIMEOUT = 5.0
+
+_SLOT_COLUMNS = ("id, session_date, session_time, session_start, available, "
+                 "customer_user_id, customer_username, customer_name, updated")
+
+
+class AvailabilityIndex:
+    def __init__(self):
+        # held for reading and updating the index, never around the database
+        self.lock = threading.RLock()
+        self._applied = threading.Condition(self.lock)
+        # seq of the last write of the timeline in the index
+        self.change = 0
+        self._sessions: Dict[int, Slot] = {}
+        # day -> [(session_time, id)] sorted, all sessions and available ones
+        self._days: Dict[str, List[Tuple[str, int]]] = {}
+        self._available: Dict[str, List[Tuple[str, int]]] = {}
+        # user_id -> ids of the booked sessions
+        self._by_user: Dict[int, List[int]] = {}
+        # session id -> its hold, lapsed ones stay until db.expire_holds
+        self._holds: Dict[int, db.Hold] = {}
+        # day -> data version, changes whenever a session of the day changes
+        self._versions: Dict[str, int] = {}
+        self._counter = itertools.count(1)
+        # data version of the whole timeline
+        self.version = 0
+        # tells the versions of this index apart from the ones of earlier indexes
+        self.generation = next(_generations)
+
+    def load(self) -> None:
+        """Loads the timeline, unless the index is already newer"""
+        with db.read_connection() as conn:
+            # the rows and the seq from one snapshot
+            conn.execute("BEGIN")
+            try:
+                seq = db.change_seq(conn)
+                rows = conn.execute(f"SELECT {_SLOT_COLUMNS} FROM timeline").fetchall()
+                holds = db.all_holds(conn)
+            finally:
+                conn.rollback()
+        with self.lock:
+            if seq < self.change:
+                return
+            self._sessions, self._days, self._available, self._by_user = {}, {}, {}, {}
+            self._versions = {}
+            for row in rows:
+                self._add(Slot(*row[:4], bool(row[4]), *row[5:]))
+            self._holds = holds
+            self.change = seq
+            self._applied.notify_all()
+
+    def sync(self) -> None:
+        """Loads the index again if another process wrote to the timeline"""
+        if db.changed_elsewhere(self.change):
+            self.load()
+
+    def apply(self, change: Optional[db.Change],
+              update: Optional[Callable[[], None]] = None) -> None:
+        """Runs update, which makes the committed write in the index, and
+        applies the holds of the change, after the writes before it. A write
+        the index has from load() is skipped. If the write before is another
+        process's or doesn't show up, the index is loaded again."""
+        if change is None:
+            return
+        while True:
+            with self._applied:
+                if change.seq <= self.change:
+                    return
+                if change.seq == self.change + 1:
+                    if update is not None:
+                        update()
+                    self._apply_holds(change.holds)
+                    self.change = change.seq
+                    self._applied.notify_all()
+                    return
+                if change.follows_own and self._applied.wait_for(
+                        lambda: self.change >= change.seq - 1, APPLY_TIMEOUT):
+                    continue
+            self.load()
+
+    def _apply_holds(self, holds: Dict[int, Optional[db.Hold]]) -> None:
+        for session_id, hold in holds.items():
+            if hold is None:
+                self._holds.pop(session_id, None)
+            else:
+                self._holds[session_id] = hold
+
+    def _add(self, slot: Slot) -> None:
+        self._sessions[slot.id] = slot
+        self._versions[slot.session_date] = self.version = next(self._counter)
+        key = (slot.session_time, slot.id)
+        bisect.insort(self._days.setdefault(slot.session_date, []), key)
+        if slot.available:
+            bisect.insort(self._available.setdefault(slot.session_date, []), key)
+        elif slot.customer_user_id is not None:
+            self._by_user.setdefault(slot.customer_user_id, []).append(slot.id)
+
+    def _remove(self, session_id: int) -> Optional[Slot]:
+        slot = self._sessions.pop(session_id, None)
+        if slot is None:
+            return None
+        key = (slot.session_time, slot.id)
+        self._versions[slot.session_date] = self.version = next(self._counter)
+        _discard(self._days, slot.session_date, key)
+        if slot.session_date not in self._days:
+            del self._versions[slot.session_date]
+        if slot.available:
+            _discard(self._available, slot.session_date, key)
+        elif slot.customer_user_id is not None:
+            user_sessions = self._by_user.get(slot.customer_user_id, [])
+            if slot.id in user_sessions:
+                user_sessions.remove(slot.id)
+            if not user_sessions:
+                self._by_user.pop(slot.customer_user_id, None)
+        return slot
+
+    def add(self, slots: List[Slot]) -> None:
+        with self.lock:
+            for slot in slots:
+                self._add(slot)
+
+    def remove(self, session_id: int) -> None:
+        with self.lock:
+            self._remove(session_id)
+
+    def remove_day(self, day: str) -> None:
+        with self.lock:
+            for _, session_id in list(self._days.get(day, [])):
+                self._remove(session_id)
+
+    def remove_before(self, now: int, today: str) -> None:
+        """Removes the sessions that started before now.
+        Only the days up to today are looked at."""
+        with self.lock:
+            for day in sorted(self._days):
+                if day > today:
+                    break
+                for _, session_id in list(self._days[day]):
+                    if self._sessions[session_id].session_start < now:
+                        self._remove(session_id)
+
+    def book(self, session_id: int, user_id: int, username: str,
+             user_fullname: str, booking_time: str) -> None:
+        with self.lock:
+            slot = self._remove(session_id)
+            if slot is not None:
+                self._add(slot._replace(available=False, customer_user_id=user_id,
+                                        customer_username=username,
+                                        customer_name=user_fullname,
+                                        updated=booking_time))
+
+    def reset(self, session_id: int) -> None:
+        with self.lock:
+            slot = self._remove(session_id)
+            if slot is not None:
+                self._add(slot._replace(available=True, customer_user_id=None,
+                                        customer_username=None, customer_name=None,
+                                        updated=None))
+
+    def all_sessions(self) -> "OrderedDict[str, List[Slot]]":
+        with self.lock:
+            return OrderedDict(
+                (day, [self._sessions[session_id] for _, session_id in self._days[day]])
+                for day in sorted(self._days))
+
+    def available_sessions(self, now: int,
+                           user_id: Optional[int] = None) -> "OrderedDict[str, List[Slot]]":
+        """Available sessions that start after now, by day, without the
+        ones held for a client other than user_id"""
+        result = OrderedDict()
+        with self.lock:
+            for day in sorted(self._available):
+                slots = [self._sessions[session_id] for _, session_id in self._available[day]]
+                slots = [slot for slot in slots
+                         if slot.session_start > now and self._free_for(slot.id, user_id, now)]
+                if slots:
+                    result[day] = slots
+        return result
+
+    def _free_for(self, session_id: int, user_id: Optional[int], now: int) -> bool:
+        hold = self._holds.get(session_id)
+        return hold is None or hold.expires <= now or hold.user_id == user_id
+
+    def next_hold_expiry(self) -> Optional[int]:
+        """When the next hold lapses, None without holds"""
+        with self.lock:
+            return min((hold.expires for hold in self._holds.values()), default=None)
+
+    def booked_sessions(self) -> "OrderedDict[str, List[Slot]]":
+        result = OrderedDict()
+        with self.lock:
+            for day in sorted(self._days):
+                slots = [self._sessions[session_id] for _, session_id in self._days[day]]
+                slots = [slot for slot in slots if not slot.available]
+                if slots:
+                    result[day] = slots
+        return result
+
+    def client_session(self, user_id: int) -> Optional[Slot]:
+        with self.lock:
+            user_sessions = self._by_user.get(user_id)
+            if not user_sessions:
+                return None
+            return self._sessions[user_sessions[0]]
+
+    def day_versions(self) -> Dict[str, int]:
+        """Data version of every day in the timeline"""
+        with self.lock:
+            return dict(self._versions)
+
+    def get(self, session_id: int) -> Optional[Slot]:
+        return self._sessions.get(session_id)
+
+    def check_consistency(self) -> List[int]:
+        """Compares the index with the database, returns the ids of the
+        sessions that differ or whose hold differs"""
+        fresh = AvailabilityIndex()
+        fresh.load()
+        with self.lock:
+            ids = set(self._sessions) | set(fresh._sessions) | set(self._holds) | set(fresh._holds)
+            return sorted(session_id for session_id in ids
+                          if self._sessions.get(session_id) != fresh._sessions.get(session_id)
+                          or self._holds.get(session_id) != fresh._holds.get(session_id))
+
+
+def _discard(buckets: Dict[str, List[Tuple[str, int]]], day: str, key: Tuple[str, int]) -> None:
+    bucket = buckets.get(day)
+    if not bucket:
+        return
+    position = bisect.bisect_left(bucket, key)
+    if position < len(bucket) and bucket[position] == key:
+        del bucket[position]
+    if not bucket:
+        del buckets[day]
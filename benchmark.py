@@ -0,0 +1,407 @@
+"""Handler benchmarks.
+
+Seeds a fresh database with N sessions, with or without bookings, and
+drives the handlers of server.py through a fake Bot that records the
+calls instead of sending them. For every handler it reports latency
+percentiles and the number of SQL statements per call, and saves the
+results as JSON so that runs can be compared:
+
+    python benchmark.py --sizes 1000 10000 100000 --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+With --statements it instead times db.booking and db.reset_session per
+call with the statement cache of the connections on and off:
+
+    python benchmark.py --statements
+
+With --export N it exports N seeded sessions to CSV, checks the file and
+reports the time and the peak memory of the export:
+
+    python benchmark.py --export 100000
+
+Run it from the project folder, it needs createdb.sql. Every scenario
+runs in its own process with its own database in a temporary folder."""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+ADMIN_ID = 1
+CLIENT_ID = 1_000_000
+SESSIONS_PER_DAY = 10
+PAST_SHARE = 0.01
+REMINDERS = 100
+
+
+class Counter:
+    """Counts the SQL statements run by all connections"""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, statement: str) -> None:
+        with self._lock:
+            self.value += 1
+
+
+def _instrument(counter: Counter) -> None:
+    import db
+    connect = db._connect
+
+    def counting_connect(*args, **kwargs) -> sqlite3.Connection:
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(counter)
+        return conn
+    db._connect = counting_connect
+
+
+def _fake_bot(token: str):
+    from aiogram import Bot
+
+    class FakeBot(Bot):
+        """Records the requests instead of sending them"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.calls = []
+            self._message_ids = itertools.count(1)
+
+        async def request(self, method, data=None, files=None, **kwargs):
+            self.calls.append(method)
+            return {"message_id": next(self._message_ids), "date": 0,
+                    "chat": {"id": (data or {}).get("chat_id", 0), "type": "private"},
+                    "text": str((data or {}).get("text"))}
+
+    return FakeBot(token=token)
+
+
+def _seed(sessions: int, booked: bool) -> Dict:
+    """Inserts the sessions, every second one booked if booked,
+    PAST_SHARE of them in the past and REMINDERS reminders due now"""
+    import clock
+    import db
+    now = clock.now()
+    first_day = now.date() + datetime.timedelta(days=1)
+    past = int(sessions * PAST_SHARE)
+    rows, booked_ids = [], []
+    for i in range(sessions):
+        if i < past:
+            day = now.date() - datetime.timedelta(days=1 + i // SESSIONS_PER_DAY)
+        else:
+            day = first_day + datetime.timedelta(days=(i - past) // SESSIONS_PER_DAY)
+        session_time = datetime.time(8 + i % SESSIONS_PER_DAY)
+        row = [str(day), str(session_time), clock.to_epoch(day, session_time), True,
+               None, None, None, None]
+        if booked and i % 2:
+            row[3:] = [False, CLIENT_ID + i, f"client{i}", f"Client {i}",
+                       now.strftime("%Y-%m-%d %H:%M:%S")]
+            booked_ids.append(i + 1)
+        rows.append(row)
+    with db.write_connection() as conn:
+        conn.executemany(
+            "INSERT INTO timeline (session_date, session_time, session_start, available, "
+            "customer_user_id, customer_username, customer_name, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.executemany(
+            "INSERT INTO reminders (session_id, user_id, kind, due_at) "
+            "VALUES (?, ?, 'hours', ?)",
+            [(session_id, CLIENT_ID + session_id - 1, clock.now_epoch() - 1)
+             for session_id in booked_ids[:REMINDERS]])
+    available_ids = [i + 1 for i, row in enumerate(rows) if row[3] and i >= past]
+    days = sorted({row[0] for i, row in enumerate(rows) if i >= past})
+    return {"available_ids": available_ids, "days": days}
+
+
+def _message(text: str, user_id: int):
+    from aiogram import types
+    return types.Message(**{
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench",
+                 "username": f"user{user_id}"}})
+
+
+def _call(payload, user_id: int):
+    import callbacks
+    from aiogram import types
+    return types.CallbackQuery(**{
+        "id": "1", "chat_instance": "bench", "data": callbacks.encode(payload),
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench",
+                 "username": f"user{user_id}"},
+        "message": {"message_id": 1, "date": 0, "text": "picker",
+                    "chat": {"id": user_id, "type": "private"}}})
+
+
+def _summary(latencies: List[float], queries: List[int]) -> Dict:
+    latencies = sorted(latencies)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive") \
+        if len(latencies) > 1 else latencies * 99
+    return {
+        "runs": len(latencies),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "p50_ms": round(percentiles[49] * 1000, 3),
+        "p90_ms": round(percentiles[89] * 1000, 3),
+        "p99_ms": round(percentiles[98] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "queries_per_run": round(statistics.mean(queries), 2),
+    }
+
+
+async def _measure(counter: Counter, runs: int, make_call: Callable[[int], object]) -> Dict:
+    latencies, queries = [], []
+    for run in range(runs):
+        counter.value = 0
+        started = time.perf_counter()
+        await make_call(run)
+        latencies.append(time.perf_counter() - started)
+        queries.append(counter.value)
+    return _summary(latencies, queries)
+
+
+async def _run_handlers(counter: Counter, seeded: Dict, runs: int) -> Dict:
+    import async_db
+    import callbacks
+    import reminders
+    import server
+    available_ids, days = seeded["available_ids"], seeded["days"]
+    # disjoint sessions and days for the handlers that change them
+    book_ids = available_ids[:runs]
+    delete_ids = available_ids[runs:2 * runs]
+    delete_days = days[-runs:]
+    results = {
+        "send_welcome": await _measure(
+            counter, runs, lambda run: server.send_welcome(_message("/start", CLIENT_ID))),
+        "book_session": await _measure(
+            counter, runs, lambda run: server.book_session(_message("/book_session", CLIENT_ID))),
+        "view_timeline": await _measure(
+            counter, runs, lambda run: server.view_timeline(_message("/timeline", ADMIN_ID))),
+        "del_from_timeline": await _measure(
+            counter, runs, lambda run: server.del_from_timeline(_message("/delete", ADMIN_ID))),
+        "callback_book": await _measure(
+            counter, runs, lambda run: server.callback_inline(
+                _call(callbacks.Book(book_ids[run]), 2 * CLIENT_ID + run))),
+        "callback_cancel": await _measure(
+            counter, runs, lambda run: server.callback_inline(
+                _call(callbacks.Cancel(book_ids[run]), 2 * CLIENT_ID + run))),
+        "callback_del": await _measure(
+            counter, runs, lambda run: server.callback_inline(
+                _call(callbacks.Delete(delete_ids[run]), ADMIN_ID))),
+        "callback_del_all": await _measure(
+            counter, runs, lambda run: server.callback_inline(
+                _call(callbacks.DeleteAll(delete_days[run]), ADMIN_ID))),
+    }
+
+    async def reminder_pass(run: int) -> None:
+        scheduler = reminders.ReminderScheduler()
+        await scheduler.load()
+        await scheduler.run_due(server.send_reminders)
+    results["user_reminder"] = await _measure(counter, 1, reminder_pass)
+    results["refresh_db"] = await _measure(counter, runs, lambda run: async_db.refresh_db())
+    return results
+
+
+def _use_temp_tenant(token: str) -> None:
+    folder = tempfile.mkdtemp(prefix="bench")
+    tenants_file = os.path.join(folder, "tenants.json")
+    with open(tenants_file, "w") as f:
+        json.dump([{"key": "bench", "token": token, "admin_id": ADMIN_ID,
+                    "db_path": os.path.join(folder, "bench.db")}], f)
+    os.environ["TENANTS_FILE"] = tenants_file
+
+
+def run_scenario(sessions: int, booked: bool, runs: int) -> Dict:
+    """Runs the handlers against a fresh database in this process"""
+    token = "123456:bench"
+    _use_temp_tenant(token)
+    counter = Counter()
+    _instrument(counter)
+
+    import appointment
+    import server
+    import tenants
+    from aiogram import Bot
+    from notifier import Notifier
+    tenant = tenants.all_tenants()[0]
+    bot = _fake_bot(token)
+    bot["tenant"] = tenant
+    server._bots[tenant.key] = bot
+    # measure the handlers, not the flood control of Telegram
+    server._notifiers[tenant.key] = Notifier(bot, rate=10 ** 6, chat_interval=0)
+    Bot.set_current(bot)
+
+    started = time.perf_counter()
+    seeded = _seed(sessions, booked)
+    seed_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    appointment.get_day_versions()
+    index_seconds = time.perf_counter() - started
+    runs = min(runs, len(seeded["days"]) // 3, len(seeded["available_ids"]) // 3)
+    handlers = asyncio.run(_run_handlers(counter, seeded, runs))
+    return {"sessions": sessions, "booked": booked,
+            "seed_s": round(seed_seconds, 3), "index_load_s": round(index_seconds, 3),
+            "bot_calls": len(bot.calls), "handlers": handlers}
+
+
+def run_statements(cache_size: int, runs: int) -> Dict:
+    """Books and frees sessions with the given statement cache size
+    and returns the mean time per call of db.booking and db.reset_session"""
+    _use_temp_tenant("123456:bench")
+    import db
+    db.STATEMENT_CACHE_SIZE = cache_size
+    session_ids = _seed(max(runs, 100), booked=False)["available_ids"]
+    timings = {"booking": [], "reset_session": []}
+    for run in range(runs):
+        session_id = session_ids[run % len(session_ids)]
+        started = time.perf_counter()
+        db.booking(session_id, CLIENT_ID + run, f"client{run}", f"Client {run}",
+                   "2030-01-01 00:00:00")
+        timings["booking"].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        db.reset_session(session_id)
+        timings["reset_session"].append(time.perf_counter() - started)
+    return {name: round(statistics.mean(values) * 10 ** 6, 1) for name, values in timings.items()}
+
+
+def statements_benchmark(runs: int) -> None:
+    """Prints the per call time of the booking and reset paths
+    with and without the statement cache"""
+    import db
+    results = {}
+    for cache_size in (db.STATEMENT_CACHE_SIZE, 0):
+        output = subprocess.run(
+            [sys.executable, __file__, "--runs", str(runs), "--statements-cache", str(cache_size)],
+            check=True, stdout=subprocess.PIPE, text=True).stdout
+        results[cache_size] = json.loads(output.strip().splitlines()[-1])
+    cached, uncached = results[db.STATEMENT_CACHE_SIZE], results[0]
+    print(f"{'path':<20}{'cached us':>12}{'uncached us':>14}{'saved us':>12}")
+    for name in cached:
+        print(f"{name:<20}{cached[name]:>12}{uncached[name]:>14}"
+              f"{round(uncached[name] - cached[name], 1):>12}")
+
+
+def export_benchmark(sessions: int) -> None:
+    """Time and peak memory of exporting the seeded sessions, half of them
+    archived and booked. test_export.py checks the rows of the CSV."""
+    _use_temp_tenant("123456:bench")
+    import clock
+    import db
+    import export
+    _seed(sessions // 2, booked=True)
+    db.archive_past_sessions(clock.now_epoch() + 365 * 24 * 3600 * 2)
+    _seed(sessions - sessions // 2, booked=False)
+    started = time.perf_counter()
+    export.export("")[0].close()
+    seconds = time.perf_counter() - started
+    # again for the memory, tracemalloc slows it down
+    tracemalloc.start()
+    file, name, count = export.export("")
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    with file:
+        size = os.fstat(file.fileno()).st_size
+    print(f"{name}: {count} sessions, {size / 2 ** 20:.1f} MiB in {seconds:.2f}s, "
+          f"peak memory {peak / 2 ** 20:.2f} MiB")
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Lines about the handlers that got slower or run more queries than in the baseline"""
+    old = {(s["sessions"], s["booked"], name): numbers
+           for s in baseline["scenarios"] for name, numbers in s["handlers"].items()}
+    lines = []
+    for scenario in results["scenarios"]:
+        for name, numbers in scenario["handlers"].items():
+            before = old.get((scenario["sessions"], scenario["booked"], name))
+            if before is None:
+                continue
+            label = f"{name} n={scenario['sessions']} booked={scenario['booked']}"
+            if numbers["p50_ms"] > before["p50_ms"] * threshold:
+                lines.append(f"{label}: p50 {before['p50_ms']} -> {numbers['p50_ms']} ms")
+            if numbers["queries_per_run"] > before["queries_per_run"]:
+                lines.append(f"{label}: queries {before['queries_per_run']} -> "
+                             f"{numbers['queries_per_run']}")
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--runs", type=int, default=30, help="calls per handler")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="JSON of an earlier run")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="p50 ratio reported as a regression")
+    parser.add_argument("--statements", action="store_true",
+                        help="time the booking and reset statements with and without "
+                             "the statement cache")
+    parser.add_argument("--export", type=int, metavar="SESSIONS",
+                        help="export that many sessions to CSV")
+    parser.add_argument("--scenario", nargs=2, metavar=("SESSIONS", "BOOKED"),
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--statements-cache", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.statements_cache is not None:
+        print(json.dumps(run_statements(args.statements_cache, args.runs)))
+        return
+    if args.statements:
+        statements_benchmark(args.runs)
+        return
+    if args.export:
+        export_benchmark(args.export)
+        return
+
+    if args.scenario:
+        sessions, booked = int(args.scenario[0]), args.scenario[1] == "1"
+        print(json.dumps(run_scenario(sessions, booked, args.runs)))
+        return
+
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "runs": args.runs,
+        "scenarios": [],
+    }
+    for sessions in args.sizes:
+        for booked in (False, True):
+            output = subprocess.run(
+                [sys.executable, __file__, "--runs", str(args.runs),
+                 "--scenario", str(sessions), str(int(booked))],
+                check=True, stdout=subprocess.PIPE, text=True).stdout
+            scenario = json.loads(output.strip().splitlines()[-1])
+            results["scenarios"].append(scenario)
+            print(f"\n{sessions} sessions, booked={booked} "
+                  f"(seeded in {scenario['seed_s']}s, index loaded in {scenario['index_load_s']}s)")
+            print(f"{'handler':<20}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+                  f"{'max ms':>10}{'queries':>10}")
+            for name, numbers in scenario["handlers"].items():
+                print(f"{name:<20}{numbers['p50_ms']:>10}{numbers['p90_ms']:>10}"
+                      f"{numbers['p99_ms']:>10}{numbers['max_ms']:>10}"
+                      f"{numbers['queries_per_run']:>10}")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        print("\n".join(regressions) if regressions else "No regressions")
+
+
+if __name__ == "__main__":
+    main()
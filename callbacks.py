@@ -0,0 +1,174 @@
+"""Callback data of the inline buttons.
+
+Telegram gives a button at most 64 bytes of callback data. A payload is a
+NamedTuple; it's written as the short prefix of its type and its fields
+joined by ':', with ids in base 36 and days as YYYYMMDD. A payload that
+doesn't fit anyway is kept in a token store for TOKEN_TTL seconds and the
+button carries the token only. Everything else the handlers need, like
+the client of a session, is looked up when the button is pressed."""
+
+import secrets
+import time
+from typing import Awaitable, Callable, Dict, NamedTuple, NewType, Optional, Tuple, Type
+
+from aiogram import types
+
+MAX_LENGTH = 64
+TOKEN_TTL = 24 * 3600
+TOKEN_PREFIX = "~"
+
+# 'YYYY-MM-DD' day of the timeline
+Day = NewType("Day", str)
+
+
+class Page(NamedTuple):
+    """Page of the days of a picker, picker is 'book' or 'del'"""
+    picker: str
+    page: int
+
+
+class ShowDay(NamedTuple):
+    """Sessions of a day in a picker"""
+    picker: str
+    day: Day
+
+
+class Back(NamedTuple):
+    """Back to the page of the days where the day is"""
+    picker: str
+    day: Day
+
+
+class Book(NamedTuple):
+    session_id: int
+
+
+class Delete(NamedTuple):
+    session_id: int
+
+
+class DeleteAll(NamedTuple):
+    day: Day
+
+
+class Cancel(NamedTuple):
+    session_id: int
+
+
+class JoinWaitlist(NamedTuple):
+    """Waitlist of any session"""
+
+
+_PREFIXES: Dict[Type[NamedTuple], str] = {
+    Page: "p",
+    ShowDay: "s",
+    Back: "k",
+    Book: "b",
+    Delete: "d",
+    DeleteAll: "a",
+    Cancel: "c",
+    JoinWaitlist: "w",
+}
+_TYPES = {prefix: payload_type for payload_type, prefix in _PREFIXES.items()}
+
+# token -> (expiry time, payload)
+_tokens: Dict[str, Tuple[float, NamedTuple]] = {}
+
+
+def _encode_field(field_type, value) -> str:
+    if field_type is int:
+        return _base36(value)
+    if field_type is Day:
+        return value.replace("-", "")
+    return str(value)
+
+
+def _decode_field(field_type, text: str):
+    if field_type is int:
+        return int(text, 36)
+    if field_type is Day:
+        return f"{text[:4]}-{text[4:6]}-{text[6:8]}"
+    return text
+
+
+def _base36(number: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    sign = "-" if number < 0 else ""
+    number = abs(number)
+    result = ""
+    while True:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+        if not number:
+            return sign + result
+
+
+def encode(payload: NamedTuple) -> str:
+    """Callback data of the payload"""
+    payload_type = type(payload)
+    fields = [_encode_field(payload_type.__annotations__[name], value)
+              for name, value in zip(payload_type._fields, payload)]
+    data = ":".join([_PREFIXES[payload_type], *fields])
+    if len(data.encode()) <= MAX_LENGTH and ":" not in "".join(fields):
+        return data
+    return TOKEN_PREFIX + _store(payload)
+
+
+def decode(data: str) -> Optional[NamedTuple]:
+    """The payload of the callback data.
+    None if it's unknown or its token has expired."""
+    if data.startswith(TOKEN_PREFIX):
+        return _load(data[len(TOKEN_PREFIX):])
+    prefix, *fields = data.split(":")
+    payload_type = _TYPES.get(prefix)
+    if payload_type is None or len(fields) != len(payload_type._fields):
+        return None
+    try:
+        return payload_type(*(_decode_field(payload_type.__annotations__[name], field)
+                              for name, field in zip(payload_type._fields, fields)))
+    except ValueError:
+        return None
+
+
+def _store(payload: NamedTuple) -> str:
+    now = time.monotonic()
+    for token in [token for token, (expires, _) in _tokens.items() if expires < now]:
+        del _tokens[token]
+    token = secrets.token_urlsafe(12)
+    _tokens[token] = (now + TOKEN_TTL, payload)
+    return token
+
+
+def _load(token: str) -> Optional[NamedTuple]:
+    entry = _tokens.get(token)
+    if entry is None or entry[0] < time.monotonic():
+        return None
+    return entry[1]
+
+
+def button(text: str, payload: NamedTuple) -> types.InlineKeyboardButton:
+    return types.InlineKeyboardButton(text, callback_data=encode(payload))
+
+
+Handler = Callable[[types.CallbackQuery, NamedTuple], Awaitable]
+
+
+class CallbackRouter:
+    """Calls the handler of the payload type of the pressed button"""
+
+    def __init__(self):
+        self._handlers: Dict[Type[NamedTuple], Handler] = {}
+
+    def handler(self, payload_type: Type[NamedTuple]) -> Callable[[Handler], Handler]:
+        def register(handler: Handler) -> Handler:
+            self._handlers[payload_type] = handler
+            return handler
+        return register
+
+    async def dispatch(self, call: types.CallbackQuery) -> bool:
+        """False if the button is unknown or expired"""
+        payload = decode(call.data)
+        if payload is None:
+            return False
+        await self._handlers[type(payload)](call, payload)
+        return True
@@ -0,0 +1,32 @@
+"""Time helpers.
+
+Session start times are stored in timeline.session_start as UTC epoch
+seconds, so comparisons are done on integers, in SQL or in Python."""
+
+import datetime
+import time
+
+import pytz
+
+TIMEZONE = pytz.timezone("Europe/Warsaw")
+
+
+def now() -> datetime.datetime:
+    """Returns now datetime with the timezone of the master"""
+    return datetime.datetime.now(TIMEZONE)
+
+
+def now_epoch() -> int:
+    return int(time.time())
+
+
+def to_epoch(session_date: datetime.date, session_time: datetime.time) -> int:
+    """Converts the local date and time of a session to epoch seconds"""
+    session_datetime = datetime.datetime.combine(session_date, session_time)
+    return int(TIMEZONE.localize(session_datetime).timestamp())
+
+
+def parse_epoch(session_date: str, session_time: str) -> int:
+    """to_epoch for the text session_date and session_time columns"""
+    return to_epoch(datetime.date.fromisoformat(session_date),
+                    datetime.time.fromisoformat(session_time))
@@ -1,96 +1,695 @@
+import datetime
+import functools
+import json
+import logging
 import os
-from typing import Dict, List, Tuple
-
+import queue
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
-conn = sqlite3.connect(os.path.join("db", "appointment.db"))
-cursor = conn.cursor()
+import clock
+import exceptions
+import metrics
+import migrations
+import tenants
 
+READ_POOL_SIZE = 4
+# rows fetched at a time by iter_sessions
+FETCH_SIZE = 500
+# prepared statements kept by every connection, the statements below
+# have fixed text and parameters so they are prepared once per connection
+STATEMENT_CACHE_SIZE = 256
 
-def insert(column_values: Dict):
-    columns = ', '.join(column_values.keys())
-    values = [tuple(column_values.values())]
-    placeholders = ", ".join("?" * len(column_values.keys()))
-    cursor.executemany(
-        f"INSERT INTO timeline "
-        f"({columns}) "
-        f"VALUES ({placeholders})",
-        values)
-    conn.commit()
+# statements slower than this are logged with their query plan, off when not set
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS")) if os.getenv("SLOW_QUERY_MS") else None
+
+# kind of the reminder, seconds before the session
+REMINDERS = (("day", 24 * 3600), ("hours", 3 * 3600))
+
+# (chat_id, text) to put into the outbox with a change
+Notifications = Iterable[Tuple[int, str]]
+
+
+class Hold(NamedTuple):
+    """A session held for a client of the waitlist until expires"""
+    user_id: int
+    expires: int
+
+
+class Change(NamedTuple):
+    """A committed write of the timeline. seq numbers the writes of all
+    processes sharing the database in the order of their commits, the
+    in-memory index applies them in that order. follows_own tells if the
+    write before it was made by this process, otherwise the index can't
+    apply it and is loaded again. holds has the session ids whose hold the
+    write made, or removed with None."""
+    seq: int
+    follows_own: bool
+    holds: Dict[int, Optional[Hold]]
+
+# seconds a freed session is held for the client it's offered to
+WAITLIST_HOLD = 15 * 60
+WAITLIST_OFFER_TEXT = ("A session is free on {date} at {time}. It's held for you for "
+                       "{minutes} minutes, book it with /book_session")
+WAITLIST_LAPSED_TEXT = ("The session on {date} at {time} wasn't booked in time and went to "
+                        "the next client on the waitlist. Join it again with /waitlist")
+
+
+# statements EXPLAIN QUERY PLAN is run for in the slow query log
+_EXPLAINED = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(\w+)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=256)
+def _statement_label(sql: str) -> str:
+    """Verb and first table of the statement, like 'SELECT timeline'"""
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else ""
+    table = _TABLE.search(sql)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+class _Cursor(sqlite3.Cursor):
+    """Cursor that times its statement together with the fetches of its
+    rows. The statement is recorded when the rows are fetched to the end,
+    or when the cursor is closed, executed again or dropped."""
+
+    _statement = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self._statement = [sql, parameters, time.perf_counter() - started]
+        if self.description is None:
+            # no rows to fetch
+            self._finish()
+        return self
+
+    def executemany(self, sql, parameters):
+        self._finish()
+        parameters = list(parameters)
+        started = time.perf_counter()
+        super().executemany(sql, parameters)
+        self.connection._record(sql, parameters[0] if parameters else None,
+                                time.perf_counter() - started)
+        return self
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(started, len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, True)
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, True)
+            raise
+        self._fetched(started, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+    def _fetched(self, started: float, done: bool) -> None:
+        if self._statement is not None:
+            self._statement[2] += time.perf_counter() - started
+            if done:
+                self._finish()
+
+    def _finish(self) -> None:
+        statement, self._statement = self._statement, None
+        if statement is not None:
+            self.connection._record(*statement)
+
+
+class _Connection(sqlite3.Connection):
+    """Connection that records the time of every statement, with the
+    fetches of its rows, in metrics and logs the slow ones"""
+
+    # PRAGMA data_version when the connection last saw no foreign change
+    checked_data_version: Optional[int] = None
+
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def _record(self, sql: str, parameters, elapsed: float):
+        metrics.db_statement_seconds.observe(elapsed, _statement_label(sql))
+        if SLOW_QUERY_MS is not None and elapsed * 1000 >= SLOW_QUERY_MS:
+            logging.warning('Slow query %.1f ms: %s', elapsed * 1000,
+                            "\n".join([" ".join(sql.split()), *self._query_plan(sql, parameters)]))
+
+    def _query_plan(self, sql: str, parameters) -> List[str]:
+        # parameters are not logged, they hold names and phone numbers
+        if parameters is None or _statement_label(sql).split(" ")[0] not in _EXPLAINED:
+            return []
+        try:
+            plan = super().execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+        except sqlite3.Error as e:
+            return [f"no query plan: {e}"]
+        return [f"  {row[-1]}" for row in plan]
+
+
+def _connect(path: str, read_only: bool = False) -> sqlite3.Connection:
+    """Opens a connection with the PRAGMAs used by the bot.
+    Connections are handed between the worker threads of async_db."""
+    if read_only:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE, factory=_Connection)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE, factory=_Connection)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-8000")
+    return conn
+
+
+class Database:
+    """Connections to the SQLite file of one tenant"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = _connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.write_lock = threading.Lock()
+        self.read_pool = queue.Queue(maxsize=READ_POOL_SIZE)
+        with self.write_lock:
+            check_db_exists(self.conn)
+            # seq of the last write of the timeline this process committed,
+            # or is committing
+            self.last_change = change_seq(self.conn)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self.read_pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self.conn.close()
+
+
+_database = tenants.TenantResource(lambda tenant: Database(tenant.db_path))
+
+
+@contextmanager
+def write_connection():
+    """The only connection that writes to the database of the current
+    tenant. Writers are serialized, the transaction is committed on exit
+    or rolled back on error."""
+    database = _database.get()
+    with database.write_lock:
+        last_change = database.last_change
+        try:
+            yield database.conn
+        except Exception:
+            database.conn.rollback()
+            database.last_change = last_change
+            raise
+        database.conn.commit()
+
+
+@contextmanager
+def read_connection():
+    """Read-only connection from the pool of the current tenant.
+    In WAL mode readers don't wait for the write connection."""
+    database = _database.get()
+    try:
+        read_conn = database.read_pool.get_nowait()
+    except queue.Empty:
+        read_conn = _connect(database.path, read_only=True)
+    try:
+        yield read_conn
+    finally:
+        try:
+            database.read_pool.put_nowait(read_conn)
+        except queue.Full:
+            read_conn.close()
+
+
+def insert_sessions(rows: List[Dict]) -> Tuple[List[int], List[int], Optional[Change]]:
+    """Inserts the sessions in one transaction. A row has the session_date,
+    session_time, session_start, available, raw_text and created columns.
+    Sessions whose session_start is already in the timeline are skipped.
+    Returns the ids of the inserted rows, in the order of rows,
+    the session_start values of the skipped ones and the change."""
+    if not rows:
+        return [], [], None
+    starts = json.dumps([row["session_start"] for row in rows])
+    with write_connection() as write_conn:
+        duplicates = {start for start, in write_conn.execute(
+            "SELECT session_start FROM timeline "
+            "WHERE session_start IN (SELECT value FROM json_each(?))", (starts,))}
+        inserted_ids = []
+        for row in rows:
+            if row["session_start"] in duplicates:
+                continue
+            cursor = write_conn.execute(
+                "INSERT INTO timeline "
+                "(session_date, session_time, session_start, available, raw_text, created) "
+                "VALUES (:session_date, :session_time, :session_start, :available, "
+                ":raw_text, :created)", row)
+            inserted_ids.append(cursor.lastrowid)
+        _count_in_stats(write_conn, "opened", "id IN (SELECT value FROM json_each(?))",
+                        (json.dumps(inserted_ids),))
+        holds = {}
+        _offer(write_conn, inserted_ids, holds)
+        change = _count_change(write_conn, holds)
+    return inserted_ids, list(duplicates), change
 
 
 def update_info(info: str):
-    cursor.execute(
-        f'UPDATE about SET about_master="{info}"')
-    conn.commit()
+    with write_connection() as write_conn:
+        write_conn.execute(
+            "UPDATE about SET about_master=?, version=version+1", (info,))
 
 
 def update_address(address_text: str):
-    cursor.execute(
-        f'UPDATE about SET raw_address="{address_text}"')
-    conn.commit()
+    with write_connection() as write_conn:
+        write_conn.execute(
+            "UPDATE about SET raw_address=?, version=version+1", (address_text,))
 
 
 def update_price(price1, price2, price3) -> None:
-    cursor.execute(
-        f'UPDATE about SET price1="{price1}", price2="{price2}", price3="{price3}" ')
-    conn.commit()
+    with write_connection() as write_conn:
+        write_conn.execute(
+            "UPDATE about SET price1=?, price2=?, price3=?, version=version+1",
+            (price1, price2, price3))
 
 
-def delete_session(session_id: int) -> None:
-    cursor.execute(f"DELETE FROM timeline WHERE id={session_id}")
-    conn.commit()
+def delete_session(session_id: int, notifications: Notifications = ()) -> Change:
+    with write_connection() as write_conn:
+        _enqueue(write_conn, notifications)
+        _count_in_stats(write_conn, "deleted", "id=?", (session_id,))
+        holds = {}
+        _release_holds(write_conn, "id=?", (session_id,), holds)
+        write_conn.execute("DELETE FROM reminders WHERE session_id=?", (session_id,))
+        write_conn.execute("DELETE FROM timeline WHERE id=?", (session_id,))
+        return _count_change(write_conn, holds)
 
 
-def delete_day(day: str) -> None:
-    cursor.execute(f"DELETE FROM timeline WHERE date(session_date)='{day}'")
-    conn.commit()
+def delete_day(day: str, notifications: Notifications = ()) -> Change:
+    with write_connection() as write_conn:
+        _enqueue(write_conn, notifications)
+        _count_in_stats(write_conn, "deleted", "session_date=?", (day,))
+        holds = {}
+        _release_holds(write_conn, "session_date=?", (day,), holds)
+        write_conn.execute("DELETE FROM reminders WHERE session_id IN "
+                           "(SELECT id FROM timeline WHERE session_date=?)", (day,))
+        write_conn.execute("DELETE FROM timeline WHERE session_date=?", (day,))
+        return _count_change(write_conn, holds)
+
+
+def archive_past_sessions(now: int) -> Tuple[int, Optional[Change]]:
+    """Moves the sessions that started before now into timeline_archive.
+    Returns the number of moved sessions and the change, None when
+    there was nothing to move."""
+    with write_connection() as write_conn:
+        write_conn.execute(
+            "INSERT INTO timeline_archive (id, customer_user_id, customer_username, "
+            "customer_name, session_date, session_time, available, raw_text, "
+            "created, updated, session_start, archived) "
+            "SELECT id, customer_user_id, customer_username, customer_name, "
+            "session_date, session_time, available, raw_text, created, updated, "
+            "session_start, ? FROM timeline WHERE session_start < ?", (now, now))
+        write_conn.execute("DELETE FROM reminders WHERE session_id IN "
+                           "(SELECT id FROM timeline WHERE session_start < ?)", (now,))
+        holds = {}
+        _release_holds(write_conn, "session_start < ?", (now,), holds)
+        today = datetime.datetime.fromtimestamp(now, clock.TIMEZONE).date().isoformat()
+        write_conn.execute("DELETE FROM waitlist WHERE day < ?", (today,))
+        cursor = write_conn.execute("DELETE FROM timeline WHERE session_start < ?", (now,))
+        if not cursor.rowcount:
+            return 0, None
+        return cursor.rowcount, _count_change(write_conn, holds)
 
 
 def booking(session_id: int, user_id: int, username: str,
-            user_fullname: str, booking_time: str) -> None:
-    cursor.execute(f'UPDATE timeline SET customer_user_id={user_id}, '
-                   f'customer_username="{username}", '
-                   f'customer_name="{user_fullname}", '
-                   f'available={False}, '
-                   f'updated="{booking_time}" '
-                   f'WHERE id={session_id}')
-    conn.commit()
+            user_fullname: str, booking_time: str,
+            by_admin: bool = False,
+            notifications: Notifications = ()) -> Tuple[List[Tuple[int, int]], Change]:
+    """Books the session if it is still available and not held for another
+    client, and schedules its reminders, in one transaction. Bookings of
+    the admin have no reminders, don't count toward the one booking per
+    client and take held sessions too. A client who books leaves the
+    waitlist. Returns the (reminder id, due time) of the scheduled
+    reminders and the change."""
+    with write_connection() as write_conn:
+        try:
+            cursor = write_conn.execute(
+                "UPDATE timeline SET customer_user_id=?, customer_username=?, "
+                "customer_name=?, available=0, updated=?, limit_exempt=? "
+                "WHERE id=? AND available=1 AND (? OR NOT EXISTS (SELECT 1 FROM holds "
+                "WHERE session_id=timeline.id AND user_id<>? AND expires>?))",
+                (user_id, username, user_fullname, booking_time, by_admin, session_id,
+                 by_admin, user_id, clock.now_epoch()))
+        except sqlite3.IntegrityError:
+            raise exceptions.AlreadyBooked("The client already has a booked session")
+        if cursor.rowcount != 1:
+            raise exceptions.SessionTaken("The session is not available")
+        _count_in_stats(write_conn, "booked", "id=?", (session_id,))
+        holds = {}
+        _release_holds(write_conn, "id=?", (session_id,), holds)
+        _enqueue(write_conn, notifications)
+        if by_admin:
+            return [], _count_change(write_conn, holds)
+        _leave_waitlist(write_conn, user_id, holds)
+        for kind, before in REMINDERS:
+            write_conn.execute(
+                "INSERT INTO reminders (session_id, user_id, kind, due_at) "
+                "SELECT id, customer_user_id, ?, session_start - ? FROM timeline "
+                "WHERE id=? AND session_start - ? > ?",
+                (kind, before, session_id, before, clock.now_epoch()))
+        reminders = write_conn.execute(
+            "SELECT id, due_at FROM reminders WHERE session_id=? AND sent=0",
+            (session_id,)).fetchall()
+        return reminders, _count_change(write_conn, holds)
 
 
-def reset_session(session_id: int) -> None:
-    cursor.execute(f"UPDATE timeline SET "
-                   f"customer_user_id=NULL, "
-                   f"customer_username=NULL, "
-                   f"customer_name=NULL, "
-                   f"available={True}, "
-                   f"updated=NULL "
-                   f"WHERE id={session_id}")
-    conn.commit()
+def reset_session(session_id: int, notifications: Notifications = ()) -> Change:
+    with write_connection() as write_conn:
+        _enqueue(write_conn, notifications)
+        _count_in_stats(write_conn, "cancelled", "id=? AND available=0", (session_id,))
+        write_conn.execute("DELETE FROM reminders WHERE session_id=?", (session_id,))
+        write_conn.execute("UPDATE timeline SET "
+                           "customer_user_id=NULL, "
+                           "customer_username=NULL, "
+                           "customer_name=NULL, "
+                           "available=1, "
+                           "updated=NULL, "
+                           "limit_exempt=0 "
+                           "WHERE id=?", (session_id,))
+        holds = {}
+        _offer(write_conn, [session_id], holds)
+        return _count_change(write_conn, holds)
+
+
+def join_waitlist(user_id: int, day: Optional[str]) -> bool:
+    """Puts the client at the end of the waitlist of the day, or of any
+    session when day is None. False if they are already waiting for it."""
+    with write_connection() as write_conn:
+        cursor = write_conn.execute(
+            "INSERT OR IGNORE INTO waitlist (user_id, day, created) VALUES (?, ?, ?)",
+            (user_id, day, clock.now_epoch()))
+        return cursor.rowcount == 1
+
+
+def leave_waitlist(user_id: int) -> Tuple[int, Optional[Change]]:
+    """Removes the client from the waitlist, a session held for them goes
+    to the next client. Returns the number of removed entries and the
+    change of the holds, None when no hold changed."""
+    with write_connection() as write_conn:
+        holds = {}
+        count = _leave_waitlist(write_conn, user_id, holds)
+        return count, _count_change(write_conn, holds) if holds else None
+
+
+def expire_holds(now: int) -> Tuple[int, Optional[Change], Optional[int]]:
+    """Offers the sessions whose hold lapsed to the next clients, the
+    clients who let the hold lapse leave the waitlist. Returns the number
+    of lapsed holds, the change, None when no hold lapsed, and when the
+    next hold lapses, None when there are no holds left."""
+    with write_connection() as write_conn:
+        lapsed = write_conn.execute(
+            "SELECT holds.session_id, holds.user_id, session_date, session_time "
+            "FROM holds LEFT JOIN timeline ON timeline.id=holds.session_id "
+            "WHERE expires <= ?", (now,)).fetchall()
+        holds = {}
+        for session_id, user_id, session_date, session_time in lapsed:
+            write_conn.execute("DELETE FROM holds WHERE session_id=?", (session_id,))
+            holds[session_id] = None
+            write_conn.execute("DELETE FROM waitlist WHERE user_id=?", (user_id,))
+            if session_date is not None:
+                _enqueue(write_conn, [(user_id, WAITLIST_LAPSED_TEXT.format(
+                    **_offer_format(session_date, session_time)))])
+        change = None
+        if lapsed:
+            _offer(write_conn, [session_id for session_id, *_ in lapsed], holds)
+            change = _count_change(write_conn, holds)
+        next_expiry = write_conn.execute("SELECT min(expires) FROM holds").fetchone()[0]
+        return len(lapsed), change, next_expiry
+
+
+def all_holds(conn: sqlite3.Connection) -> Dict[int, Hold]:
+    """session id -> its hold, lapsed ones too"""
+    return {session_id: Hold(user_id, expires) for session_id, user_id, expires in conn.execute(
+        "SELECT session_id, user_id, expires FROM holds")}
+
+
+def _leave_waitlist(write_conn: sqlite3.Connection, user_id: int,
+                    holds: Dict[int, Optional[Hold]]) -> int:
+    released = [session_id for session_id, in write_conn.execute(
+        "SELECT session_id FROM holds WHERE user_id=?", (user_id,))]
+    write_conn.execute("DELETE FROM holds WHERE user_id=?", (user_id,))
+    holds.update(dict.fromkeys(released))
+    cursor = write_conn.execute("DELETE FROM waitlist WHERE user_id=?", (user_id,))
+    _offer(write_conn, released, holds)
+    return cursor.rowcount
+
+
+def _offer(write_conn: sqlite3.Connection, session_ids: Iterable[int],
+           holds: Dict[int, Optional[Hold]]) -> None:
+    """Holds each of the sessions that is available and not held for the
+    first client waiting for its day or for any session, and tells them
+    through the outbox. The queues are read through their index, the
+    waitlist is never scanned. The new holds are put into holds."""
+    now = clock.now_epoch()
+    for session_id in session_ids:
+        session = write_conn.execute(
+            "SELECT session_date, session_time FROM timeline "
+            "WHERE id=? AND available=1 AND session_start > ? "
+            "AND NOT EXISTS (SELECT 1 FROM holds WHERE session_id=timeline.id)",
+            (session_id, now)).fetchone()
+        if session is None:
+            continue
+        waiter = _next_waiter(write_conn, session[0])
+        if waiter is None:
+            continue
+        waitlist_id, user_id = waiter
+        hold = Hold(user_id, now + WAITLIST_HOLD)
+        write_conn.execute(
+            "INSERT INTO holds (session_id, waitlist_id, user_id, expires) VALUES (?, ?, ?, ?)",
+            (session_id, waitlist_id, user_id, hold.expires))
+        holds[session_id] = hold
+        write_conn.execute("UPDATE waitlist SET offered=? WHERE id=?", (session_id, waitlist_id))
+        _enqueue(write_conn, [(user_id, WAITLIST_OFFER_TEXT.format(
+            minutes=WAITLIST_HOLD // 60, **_offer_format(*session)))])
+
+
+def _next_waiter(write_conn: sqlite3.Connection, day: str) -> Optional[Tuple[int, int]]:
+    """(waitlist id, user id) of the earliest entry for the day or for any
+    session whose client has no session held for them"""
+    waiters = [waiter for waiter in (
+        write_conn.execute(
+            "SELECT id, user_id FROM waitlist WHERE day=? AND offered IS NULL "
+            "AND NOT EXISTS (SELECT 1 FROM holds WHERE holds.user_id=waitlist.user_id) "
+            "ORDER BY id LIMIT 1", (day,)).fetchone(),
+        write_conn.execute(
+            "SELECT id, user_id FROM waitlist WHERE day IS NULL AND offered IS NULL "
+            "AND NOT EXISTS (SELECT 1 FROM holds WHERE holds.user_id=waitlist.user_id) "
+            "ORDER BY id LIMIT 1").fetchone(),
+    ) if waiter is not None]
+    return min(waiters) if waiters else None
+
+
+def _offer_format(session_date: str, session_time: str) -> Dict[str, str]:
+    return {"date": datetime.date.fromisoformat(session_date).strftime("%d.%m.%Y"),
+            "time": session_time[:5]}
+
+
+def _release_holds(write_conn: sqlite3.Connection, where: str, params,
+                   holds: Dict[int, Optional[Hold]]) -> None:
+    """Removes the holds of the timeline sessions that match where,
+    their clients go back to their place in the waitlist"""
+    write_conn.execute(
+        f"UPDATE waitlist SET offered=NULL "
+        f"WHERE offered IN (SELECT id FROM timeline WHERE {where})", params)
+    released = write_conn.execute(
+        f"DELETE FROM holds WHERE session_id IN (SELECT id FROM timeline WHERE {where}) "
+        f"RETURNING session_id", params).fetchall()
+    holds.update(dict.fromkeys(session_id for session_id, in released))
+
+
+def _count_change(write_conn: sqlite3.Connection,
+                  holds: Optional[Dict[int, Optional[Hold]]] = None) -> Change:
+    """Numbers the write of the timeline or of the holds in this transaction"""
+    database = _database.get()
+    seq = write_conn.execute("UPDATE changes SET seq=seq+1 RETURNING seq").fetchall()[0][0]
+    change = Change(seq, seq - 1 == database.last_change, holds or {})
+    database.last_change = seq
+    return change
+
+
+def change_seq(conn: sqlite3.Connection) -> int:
+    """seq of the last committed write of the timeline"""
+    return conn.execute("SELECT seq FROM changes").fetchone()[0]
+
+
+def changed_elsewhere(known: int) -> bool:
+    """True if another process committed a write of the timeline after
+    the known seq and after the last write of this process. While nothing
+    is committed it only reads PRAGMA data_version of a pooled connection."""
+    database = _database.get()
+    with read_connection() as read_conn:
+        data_version = read_conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == read_conn.checked_data_version:
+            return False
+        if change_seq(read_conn) > max(known, database.last_change):
+            return True
+        read_conn.checked_data_version = data_version
+        return False
+
+
+def _count_in_stats(write_conn: sqlite3.Connection, column: str, where: str, params) -> None:
+    """Adds the timeline sessions that match where to the column of their
+    day and hour in the stats rollup, in the transaction of the change"""
+    write_conn.execute(
+        f"INSERT INTO stats (day, hour, {column}) "
+        f"SELECT session_date, CAST(substr(session_time, 1, 2) AS integer), count(*) "
+        f"FROM timeline WHERE {where} GROUP BY 1, 2 "
+        f"ON CONFLICT (day, hour) DO UPDATE SET {column}={column}+excluded.{column}",
+        params)
+
+
+def get_stats(first_day: str, last_day: str) -> List[Tuple[str, int, int, int, int, int]]:
+    """(day, hour, opened, booked, cancelled, deleted) rows of the stats
+    rollup for the days from first_day to last_day"""
+    with read_connection() as read_conn:
+        return read_conn.execute(
+            "SELECT day, hour, opened, booked, cancelled, deleted FROM stats "
+            "WHERE day BETWEEN ? AND ?", (first_day, last_day)).fetchall()
+
+
+def iter_sessions(start: int, end: int) -> Iterator[tuple]:
+    """Archived and current sessions that start from start to before end,
+    in the order of their start. Rows are (id, session_date, session_time,
+    available, customer_user_id, customer_username, customer_name, updated,
+    created, archived), archived is NULL for the timeline. The rows are
+    fetched FETCH_SIZE at a time and a read connection is held until the
+    iterator is exhausted or closed."""
+    with read_connection() as read_conn:
+        for sql in ("SELECT id, session_date, session_time, available, customer_user_id, "
+                    "customer_username, customer_name, updated, created, archived "
+                    "FROM timeline_archive WHERE session_start >= ? AND session_start < ? "
+                    "ORDER BY session_start",
+                    "SELECT id, session_date, session_time, available, customer_user_id, "
+                    "customer_username, customer_name, updated, created, NULL "
+                    "FROM timeline WHERE session_start >= ? AND session_start < ? "
+                    "ORDER BY session_start"):
+            cursor = read_conn.execute(sql, (start, end))
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+
+
+def claim_reminder(reminder_id: int) -> bool:
+    """Marks the reminder as sent. False if it was already sent or removed"""
+    with write_connection() as write_conn:
+        cursor = write_conn.execute(
+            "UPDATE reminders SET sent=1 WHERE id=? AND sent=0", (reminder_id,))
+        return cursor.rowcount == 1
+
+
+def _enqueue(write_conn: sqlite3.Connection, notifications: Notifications) -> None:
+    """Puts the notifications into the outbox, in the transaction
+    of the change they are about"""
+    now = clock.now_epoch()
+    write_conn.executemany(
+        "INSERT INTO outbox (chat_id, text, created, next_attempt) VALUES (?, ?, ?, ?)",
+        [(chat_id, text, now, now) for chat_id, text in notifications])
+
+
+def claim_outbox(now: int, limit: int, lease: int) -> List[Tuple[int, int, str, int]]:
+    """Takes up to limit notifications that are due for sending.
+    They are not handed out again for lease seconds.
+    Returns (id, chat_id, text, attempts) rows."""
+    with write_connection() as write_conn:
+        rows = write_conn.execute(
+            "SELECT id, chat_id, text, attempts FROM outbox "
+            "WHERE next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+            (now, limit)).fetchall()
+        write_conn.executemany(
+            "UPDATE outbox SET next_attempt=? WHERE id=?",
+            [(now + lease, row[0]) for row in rows])
+    return rows
 
 
+def finish_outbox(sent_ids: List[int], retries: List[Tuple[int, Optional[int]]]) -> None:
+    """Removes the sent notifications. retries are (id, next attempt time),
+    the notifications given up on get NULL and stay for inspection."""
+    with write_connection() as write_conn:
+        write_conn.executemany("DELETE FROM outbox WHERE id=?",
+                               [(outbox_id,) for outbox_id in sent_ids])
+        write_conn.executemany(
+            "UPDATE outbox SET attempts=attempts+1, next_attempt=? WHERE id=?",
+            [(next_attempt, outbox_id) for outbox_id, next_attempt in retries])
 
 
-def get_cursor():
-    return cursor
+def next_outbox_attempt() -> Optional[int]:
+    """Time of the next due notification, None if there are none"""
+    with read_connection() as read_conn:
+        return read_conn.execute("SELECT min(next_attempt) FROM outbox").fetchone()[0]
 
 
-def _init_db():
+def _init_db(conn: sqlite3.Connection):
     """init db"""
     with open("createdb.sql", "r") as f:
         sql = f.read()
-    cursor.executescript(sql)
+    conn.executescript(sql)
     conn.commit()
 
 
-def check_db_exists():
-    """Checks if the database is initialized, if not - initializes"""
-    cursor.execute("SELECT name FROM sqlite_master "
-                   "WHERE type='table' AND name='timeline' OR type='table' AND name='about'")
-    table_exists = cursor.fetchall()
-    if table_exists:
-        return
-    _init_db()
+def explain_query_plan(sql: str, params=()) -> List[str]:
+    """Returns the EXPLAIN QUERY PLAN details of the statement"""
+    with read_connection() as read_conn:
+        plan = read_conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [row[-1] for row in plan]
 
 
-check_db_exists()
+def check_db_exists(conn: sqlite3.Connection):
+    """Checks if the database is initialized, if not - initializes.
+    Then brings the schema up to date with the migrations."""
+    table_exists = conn.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type='table' AND name='timeline' OR type='table' AND name='about'"
+    ).fetchall()
+    if not table_exists:
+        _init_db(conn)
+    migrations.migrate(conn)
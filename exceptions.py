@@ -4,3 +4,13 @@
 class NotCorrectMessage(Exception):
     """Incorrect message to bot that couldn't be parsed"""
     pass
+
+
+class SessionTaken(Exception):
+    """The session was booked by someone else or removed"""
+    pass
+
+
+class AlreadyBooked(Exception):
+    """The client already has a booked session"""
+    pass
@@ -0,0 +1,94 @@
+"""CSV export of the sessions for the admin.
+
+Rows come from db.iter_sessions a batch at a time and are written to a
+temporary file, which the bot sends as a document, so the memory used
+doesn't depend on the size of the history."""
+
+import csv
+import datetime
+import functools
+import io
+import tempfile
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+
+import clock
+import db
+import exceptions
+import stats
+
+HEADER = ("id", "date", "time", "status", "client_id", "client_username", "client_name",
+          "booked_at", "created", "archived_at")
+# spreadsheets run cells starting with these as formulas
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def parse_range(args: str) -> Tuple[Optional[datetime.date], Optional[datetime.date]]:
+    """Days of '/export [first [last]]', the whole history without dates"""
+    if not args.split():
+        return None, None
+    try:
+        return stats.parse_range(args)
+    except exceptions.NotCorrectMessage:
+        raise exceptions.NotCorrectMessage(
+            "Write /export for all the sessions, or /export with the first and the last day, "
+            "for example: /export 01.04 30.04 or /export 01.04.2026 30.04.2026")
+
+
+def csv_rows(first_day: Optional[datetime.date],
+             last_day: Optional[datetime.date]) -> Iterator[tuple]:
+    """HEADER and the rows of the sessions from first_day to last_day"""
+    start = clock.to_epoch(first_day, datetime.time()) if first_day else 0
+    end = (clock.to_epoch(last_day + datetime.timedelta(days=1), datetime.time())
+           if last_day else 2 ** 62)
+    yield HEADER
+    for (session_id, session_date, session_time, available, user_id, username, name,
+         updated, created, archived) in db.iter_sessions(start, end):
+        yield (session_id, session_date, session_time[:5], "available" if available else "booked",
+               user_id or "", _cell(username), _cell(name), updated or "", created or "",
+               _archived_at(archived))
+
+
+def _cell(value: Optional[str]) -> str:
+    """The text of a client's cell that a spreadsheet won't run"""
+    if not value:
+        return ""
+    return "'" + value if value.startswith(_FORMULA_PREFIXES) else value
+
+
+# sessions are archived in batches, so there are few distinct times
+@functools.lru_cache(maxsize=64)
+def _archived_at(archived: Optional[int]) -> str:
+    if archived is None:
+        return ""
+    return datetime.datetime.fromtimestamp(archived, clock.TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def write_csv(rows: Iterable[tuple], file: BinaryIO) -> int:
+    """Writes the rows as UTF-8 CSV, returns the number of rows after the header"""
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    count = -1
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    text.flush()
+    text.detach()
+    return count
+
+
+def export(args: str) -> Tuple[BinaryIO, str, int]:
+    """Temporary file with the CSV of '/export [first [last]]', rewound,
+    with its file name and the number of sessions in it. The caller
+    closes the file, which deletes it."""
+    first_day, last_day = parse_range(args)
+    file = tempfile.TemporaryFile()
+    try:
+        count = write_csv(csv_rows(first_day, last_day), file)
+    except Exception:
+        file.close()
+        raise
+    file.seek(0)
+    name = "sessions"
+    if first_day:
+        name += f"-{first_day:%Y%m%d}-{last_day:%Y%m%d}"
+    return file, name + ".csv", count
@@ -0,0 +1,28 @@
+"""Keeper of the waitlist holds.
+
+A session freed up for the waitlist is held for the first client on it
+for db.WAITLIST_HOLD seconds. When the hold lapses the keeper passes the
+session to the next client. A tenant is due when its next hold lapses,
+and writes that may make a hold wake the keeper."""
+
+from typing import Callable, Optional
+
+import async_db
+from tenant_loop import TenantLoop
+
+# longest wait between two rounds
+INTERVAL = 60
+
+
+class HoldKeeper(TenantLoop):
+    def __init__(self, on_lapsed: Callable[[], None]):
+        super().__init__('holds', INTERVAL)
+        # called in the tenant whose holds lapsed, the next clients got
+        # their offers through the outbox
+        self._on_lapsed = on_lapsed
+
+    async def visit(self) -> Optional[int]:
+        lapsed, next_expiry = await async_db.expire_holds()
+        if lapsed:
+            self._on_lapsed()
+        return next_expiry
@@ -0,0 +1,160 @@
+"""iCalendar feeds of the sessions.
+
+The master's feed has the whole timeline and a client's feed has their
+booked session. A built feed is cached together with its ETag, which is
+derived from the data it's made of: the version of the timeline for the
+master and the booked session itself for a client. A feed is built again
+only when that data changed, and a request with a matching If-None-Match
+is answered without building anything."""
+
+import datetime
+import hashlib
+import hmac
+import secrets
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+import appointment
+import availability
+import clock
+import tenants
+
+# sessions have no length in the timeline, the events get this one
+SESSION_MINUTES = 60
+# feeds of clients kept per tenant
+MAX_CACHED_FEEDS = 256
+# ETags of this process don't match the ones of an earlier one
+_BOOT = secrets.token_hex(4)
+
+
+class Feed(NamedTuple):
+    etag: str
+    body: bytes
+
+
+class FeedCache:
+    def __init__(self):
+        self._feeds: "OrderedDict[str, Feed]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, version: tuple, build: Callable[[], bytes]) -> Feed:
+        """The cached feed if it was built from this version, otherwise builds it"""
+        etag = _etag(version)
+        feed = self._feeds.get(key)
+        if feed is None or feed.etag != etag:
+            feed = Feed(etag, build())
+        with self._lock:
+            self._feeds[key] = feed
+            self._feeds.move_to_end(key)
+            while len(self._feeds) > MAX_CACHED_FEEDS:
+                self._feeds.popitem(last=False)
+        return feed
+
+
+_caches = tenants.TenantResource(lambda tenant: FeedCache())
+
+
+def _etag(version: tuple) -> str:
+    digest = hashlib.sha256(repr((_BOOT, version)).encode()).hexdigest()[:20]
+    return f'"{digest}"'
+
+
+def master_feed() -> Feed:
+    """The whole timeline, booked sessions show the client"""
+    version = (appointment.get_timeline_version(), appointment.get_settings().version)
+    return _caches.get().get("master", version, _build_master)
+
+
+def client_feed(user_id: int) -> Feed:
+    """The booked session of the client, no events if they have none"""
+    slot = appointment.get_client_session(user_id)
+    version = (slot, appointment.get_settings().version)
+    return _caches.get().get(f"client:{user_id}", version, lambda: _build_client(slot))
+
+
+def _build_master() -> bytes:
+    address = appointment.get_settings().raw_address
+    events = []
+    for slots in appointment.get_timeline_slots().values():
+        for slot in slots:
+            if slot.available:
+                events.append(_event(slot, "Open session", address, transparent=True))
+            else:
+                name = slot.customer_name or ""
+                if slot.customer_username:
+                    name += f" @{slot.customer_username}"
+                events.append(_event(slot, f"Session: {name.strip()}", address))
+    return _calendar("Sessions", events)
+
+
+def _build_client(slot: Optional[availability.Slot]) -> bytes:
+    address = appointment.get_settings().raw_address
+    return _calendar("My session", [_event(slot, "Session", address)] if slot else [])
+
+
+def _event(slot: availability.Slot, summary: str, location: str,
+           transparent: bool = False) -> List[str]:
+    start = datetime.datetime.fromtimestamp(slot.session_start, datetime.timezone.utc)
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:session-{slot.id}-{slot.session_start}@{tenants.current().key}",
+        f"DTSTAMP:{_utc(datetime.datetime.now(datetime.timezone.utc))}",
+        f"DTSTART:{_utc(start)}",
+        f"DURATION:PT{SESSION_MINUTES}M",
+        f"SUMMARY:{_text(summary)}",
+    ]
+    if location:
+        lines.append(f"LOCATION:{_text(location)}")
+    if transparent:
+        lines.append("TRANSP:TRANSPARENT")
+    lines.append("END:VEVENT")
+    return lines
+
+
+def _calendar(name: str, events: Iterable[List[str]]) -> bytes:
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//appointment bot//EN",
+             "CALSCALE:GREGORIAN", f"X-WR-CALNAME:{_text(name)}",
+             f"X-WR-TIMEZONE:{clock.TIMEZONE.zone}"]
+    for event in events:
+        lines.extend(event)
+    lines.append("END:VCALENDAR")
+    return "".join(_fold(line) + "\r\n" for line in lines).encode()
+
+
+def _utc(moment: datetime.datetime) -> str:
+    return moment.strftime("%Y%m%dT%H%M%SZ")
+
+
+def _text(value: str) -> str:
+    """Escapes a TEXT value"""
+    return (value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def _fold(line: str) -> str:
+    """Splits the line into parts of at most 75 octets, as RFC 5545 wants"""
+    if len(line.encode()) <= 75:
+        return line
+    parts, part, size = [], "", 0
+    for char in line:
+        char_size = len(char.encode())
+        if size + char_size > 75:
+            parts.append(part)
+            # a continuation line starts with a space
+            part, size = " ", 1
+        part += char
+        size += char_size
+    parts.append(part)
+    return "\r\n".join(parts)
+
+
+def feed_signature(tenant: tenants.Tenant, owner: str) -> str:
+    """Signature of the feed URL of the owner, 'master' or a client's id.
+    It's derived from the bot token, so feed URLs can't be guessed."""
+    return hmac.new(tenant.token.encode(), f"ical:{tenant.key}:{owner}".encode(),
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def feed_path(tenant: tenants.Tenant, owner: str) -> str:
+    return f"/calendar/{tenant.key}/{owner}/{feed_signature(tenant, owner)}.ics"
@@ -0,0 +1,195 @@
+"""Versioned schema migrations.
+
+The schema version is kept in PRAGMA user_version. Migration number N is
+MIGRATIONS[N - 1]; at startup every migration newer than the database is
+applied in order, each one in its own transaction. A migration is a tuple
+of SQL statements or a function that takes the connection."""
+
+import sqlite3
+
+import clock
+import tenants
+
+
+def _add_session_start(conn: sqlite3.Connection) -> None:
+    """Adds timeline.session_start and backfills it from the text columns"""
+    conn.execute("ALTER TABLE timeline ADD COLUMN session_start integer")
+    rows = conn.execute("SELECT id, session_date, session_time FROM timeline").fetchall()
+    conn.executemany(
+        "UPDATE timeline SET session_start=? WHERE id=?",
+        [(clock.parse_epoch(session_date, session_time), session_id)
+         for session_id, session_date, session_time in rows])
+    conn.execute("CREATE INDEX timeline_start_idx ON timeline (session_start)")
+    conn.execute("CREATE INDEX timeline_available_start_idx "
+                 "ON timeline (available, session_start)")
+
+
+def _add_booking_limit(conn: sqlite3.Connection) -> None:
+    """Adds timeline.limit_exempt and a partial unique index that allows
+    one booked session per client. The admin's bookings are exempt, so
+    are the extra bookings a client made before the index existed."""
+    conn.execute("ALTER TABLE timeline ADD COLUMN limit_exempt boolean NOT NULL DEFAULT 0")
+    conn.execute("UPDATE timeline SET limit_exempt=1 WHERE available=0 AND customer_user_id=?",
+                 (tenants.current().admin_id,))
+    conn.execute("UPDATE timeline SET limit_exempt=1 WHERE available=0 AND limit_exempt=0 "
+                 "AND id NOT IN (SELECT min(id) FROM timeline WHERE available=0 "
+                 "GROUP BY customer_user_id)")
+    conn.execute("CREATE UNIQUE INDEX timeline_one_booking_idx ON timeline (customer_user_id) "
+                 "WHERE available=0 AND limit_exempt=0")
+
+
+MIGRATIONS = [
+    # 1: indexes for the timeline hot paths
+    (
+        "CREATE INDEX IF NOT EXISTS timeline_available_idx "
+        "ON timeline (available, session_date, session_time)",
+        "CREATE INDEX IF NOT EXISTS timeline_date_idx "
+        "ON timeline (session_date, session_time)",
+        "CREATE INDEX IF NOT EXISTS timeline_customer_idx "
+        "ON timeline (customer_user_id)",
+    ),
+    # 2: session start as an indexed epoch timestamp
+    _add_session_start,
+    # 3: reminders scheduled for booked sessions
+    (
+        "CREATE TABLE reminders("
+        "id integer primary key, "
+        "session_id integer, "
+        "user_id integer, "
+        "kind varchar(10), "
+        "due_at integer, "
+        "sent boolean default 0)",
+        "CREATE INDEX reminders_due_idx ON reminders (sent, due_at)",
+        "CREATE INDEX reminders_session_idx ON reminders (session_id)",
+        "INSERT INTO reminders (session_id, user_id, kind, due_at) "
+        "SELECT id, customer_user_id, 'day', session_start - 86400 FROM timeline "
+        "WHERE available=0 AND session_start - 86400 > CAST(strftime('%s', 'now') AS integer)",
+        "INSERT INTO reminders (session_id, user_id, kind, due_at) "
+        "SELECT id, customer_user_id, 'hours', session_start - 10800 FROM timeline "
+        "WHERE available=0 AND session_start - 10800 > CAST(strftime('%s', 'now') AS integer)",
+    ),
+    # 4: archive of past sessions
+    (
+        # timeline ids can be reused once archived, so id is not a key here
+        "CREATE TABLE timeline_archive("
+        "id integer, "
+        "customer_user_id integer, "
+        "customer_username varchar(255), "
+        "customer_name varchar(30), "
+        "session_date date, "
+        "session_time time, "
+        "available boolean, "
+        "raw_text text, "
+        "created datetime, "
+        "updated datetime, "
+        "session_start integer, "
+        "archived integer)",
+        "CREATE INDEX timeline_archive_start_idx ON timeline_archive (session_start)",
+    ),
+    # 5: version of the about row for the settings cache
+    (
+        "ALTER TABLE about ADD COLUMN version integer NOT NULL DEFAULT 0",
+    ),
+    # 6: outbox of notifications, written with the change they are about
+    (
+        "CREATE TABLE outbox("
+        "id integer primary key, "
+        "chat_id integer, "
+        "text text, "
+        "created integer, "
+        "attempts integer NOT NULL DEFAULT 0, "
+        "next_attempt integer)",
+        "CREATE INDEX outbox_next_attempt_idx ON outbox (next_attempt)",
+    ),
+    # 7: one booked session per client, enforced by the database
+    _add_booking_limit,
+    # 8: rollup of the sessions per day and hour for /stats, cancellations
+    # and deletions before it are not known
+    (
+        "CREATE TABLE stats("
+        "day date, "
+        "hour integer, "
+        "opened integer NOT NULL DEFAULT 0, "
+        "booked integer NOT NULL DEFAULT 0, "
+        "cancelled integer NOT NULL DEFAULT 0, "
+        "deleted integer NOT NULL DEFAULT 0, "
+        "PRIMARY KEY (day, hour))",
+        "INSERT INTO stats (day, hour, opened, booked) "
+        "SELECT session_date, CAST(substr(session_time, 1, 2) AS integer), "
+        "count(*), sum(available=0) FROM "
+        "(SELECT session_date, session_time, available FROM timeline UNION ALL "
+        "SELECT session_date, session_time, available FROM timeline_archive) "
+        "GROUP BY 1, 2",
+    ),
+    # 9: waitlist of the clients, day is NULL for any session, offered is the
+    # session held for the entry; the partial index is the queue of every day
+    (
+        "CREATE TABLE waitlist("
+        "id integer primary key, "
+        "user_id integer NOT NULL, "
+        "day date, "
+        "created integer, "
+        "offered integer)",
+        "CREATE INDEX waitlist_queue_idx ON waitlist (day, id) WHERE offered IS NULL",
+        "CREATE UNIQUE INDEX waitlist_user_idx ON waitlist (user_id, ifnull(day, ''))",
+        "CREATE INDEX waitlist_offered_idx ON waitlist (offered) WHERE offered IS NOT NULL",
+        "CREATE TABLE holds("
+        "session_id integer primary key, "
+        "waitlist_id integer NOT NULL, "
+        "user_id integer NOT NULL, "
+        "expires integer NOT NULL)",
+        "CREATE INDEX holds_expires_idx ON holds (expires)",
+        "CREATE INDEX holds_user_idx ON holds (user_id)",
+    ),
+    # 10: indexes no query uses since the reads are served by the
+    # availability index, every index slows down the writes
+    (
+        "DROP INDEX IF EXISTS timeline_available_idx",
+        "DROP INDEX IF EXISTS timeline_customer_idx",
+        "DROP INDEX IF EXISTS timeline_available_start_idx",
+    ),
+    # 11: number of the last write of the timeline, see db.Change
+    (
+        "CREATE TABLE changes(seq integer NOT NULL)",
+        "INSERT INTO changes (seq) VALUES (0)",
+    ),
+    # 12: reminder ids that are never handed out again, the scheduler's
+    # entry of a removed reminder claimed the reminder that reused its id
+    (
+        "CREATE TABLE reminders_new("
+        "id integer primary key autoincrement, "
+        "session_id integer, "
+        "user_id integer, "
+        "kind varchar(10), "
+        "due_at integer, "
+        "sent boolean default 0)",
+        "INSERT INTO reminders_new (id, session_id, user_id, kind, due_at, sent) "
+        "SELECT id, session_id, user_id, kind, due_at, sent FROM reminders",
+        "DROP TABLE reminders",
+        "ALTER TABLE reminders_new RENAME TO reminders",
+        "CREATE INDEX reminders_due_idx ON reminders (sent, due_at)",
+        "CREATE INDEX reminders_session_idx ON reminders (session_id)",
+    ),
+]
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    """Applies the migrations the database doesn't have yet"""
+    version = get_version(conn)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            if callable(migration):
+                migration(conn)
+            else:
+                for statement in migration:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={number}")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
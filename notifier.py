@@ -0,0 +1,131 @@
+"""Rate-limited sending of notifications.
+
+Telegram allows a bot about 30 messages per second overall and about one
+message per second to the same chat. Notifications are sent concurrently
+under a global token bucket and a per-chat interval. Flood control is
+bot-wide, so a RetryAfter pauses the bucket, and with it all sending, for
+the time Telegram asks and the message is sent again."""
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+import metrics
+
+GLOBAL_RATE = 30
+CHAT_INTERVAL = 1.0
+CONCURRENCY = 10
+MAX_ATTEMPTS = 3
+
+
+class Notification(NamedTuple):
+    """Structure of a message to send"""
+    chat_id: int
+    text: str
+
+
+class Report(NamedTuple):
+    """How the notifications of one send() went"""
+    delivered: int
+    retried: int
+    failed: int
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._updated:
+                    # paused
+                    await asyncio.sleep(self._updated - now)
+                    continue
+                self._tokens = min(self._capacity,
+                                   self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def pause(self, seconds: float) -> None:
+        """Gives no tokens for the seconds, then starts filling up from empty"""
+        until = time.monotonic() + seconds
+        if until > self._updated:
+            self._tokens = 0
+            self._updated = until
+
+
+class Notifier:
+    def __init__(self, bot: Bot, rate: float = GLOBAL_RATE,
+                 chat_interval: float = CHAT_INTERVAL, concurrency: int = CONCURRENCY):
+        self._bot = bot
+        self._bucket = TokenBucket(rate, rate)
+        self._chat_interval = chat_interval
+        self._concurrency = concurrency
+        self._semaphore = None
+        # chat_id -> monotonic time when the chat can get the next message
+        self._chat_next: Dict[int, float] = {}
+
+    async def send(self, notifications: Iterable[Notification]) -> Report:
+        """Sends the notifications, returns how many were delivered,
+        retried after flood control and failed"""
+        report, _ = await self.deliver(notifications)
+        return report
+
+    async def deliver(self, notifications: Iterable[Notification]) -> Tuple[Report, List[bool]]:
+        """Like send(), also tells for each notification if it was delivered"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+        counts = Counter()
+        delivered = await asyncio.gather(*(self._deliver(notification, counts)
+                                           for notification in notifications))
+        report = Report(counts['delivered'], counts['retried'], counts['failed'])
+        for result, count in counts.items():
+            metrics.notifications.inc(result, amount=count)
+        if report.retried or report.failed:
+            logging.warning('Notifications: %s', report)
+        return report, list(delivered)
+
+    async def _deliver(self, notification: Notification, counts: Counter) -> bool:
+        for _ in range(MAX_ATTEMPTS):
+            await self._wait_for_chat(notification.chat_id)
+            try:
+                async with self._semaphore:
+                    await self._bucket.acquire()
+                    await self._bot.send_message(notification.chat_id, notification.text)
+            except RetryAfter as e:
+                counts['retried'] += 1
+                self._bucket.pause(e.timeout)
+                continue
+            except Exception as e:
+                logging.warning('Error send message to %s: %r', notification.chat_id, e)
+                counts['failed'] += 1
+                return False
+            counts['delivered'] += 1
+            return True
+        counts['failed'] += 1
+        return False
+
+    async def _wait_for_chat(self, chat_id: int) -> None:
+        """Reserves the next turn of the chat and waits for it"""
+        now = time.monotonic()
+        turn = max(now, self._chat_next.get(chat_id, now))
+        self._chat_next[chat_id] = turn + self._chat_interval
+        if len(self._chat_next) > 1000:
+            self._chat_next = {chat: next_turn for chat, next_turn in self._chat_next.items()
+                               if next_turn > now}
+        if turn > now:
+            await asyncio.sleep(turn - now)
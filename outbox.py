@@ -0,0 +1,66 @@
+"""Worker that drains the notification outbox.
+
+Handlers write their notifications into the outbox table in the same
+transaction as the change they are about (see db.Notifications) and wake
+the worker. It sends them in batches through the notifier, removes the
+delivered ones and schedules failed ones for another attempt.
+
+A tenant is due when its next notification is, see tenant_loop."""
+
+import logging
+from typing import Callable, Optional
+
+import async_db
+import clock
+import tenants
+from notifier import Notification, Notifier, Report
+from tenant_loop import TenantLoop
+
+BATCH_SIZE = 50
+INTERVAL = 30
+LEASE = 300
+MAX_ATTEMPTS = 5
+
+
+def retry_delay(attempts: int) -> int:
+    """Seconds until the next attempt after the given number of failed ones"""
+    return min(60 * 2 ** attempts, 3600)
+
+
+class OutboxWorker(TenantLoop):
+    def __init__(self, notifier_for: Callable[[tenants.Tenant], Notifier]):
+        super().__init__('outbox', INTERVAL)
+        self._notifier_for = notifier_for
+
+    async def drain(self) -> Report:
+        """Sends everything of the current tenant that is due, batch by batch"""
+        notifier = self._notifier_for(tenants.current())
+        delivered = retried = failed = 0
+        while True:
+            now = clock.now_epoch()
+            rows = await async_db.claim_outbox(now, BATCH_SIZE, LEASE)
+            if not rows:
+                break
+            report, results = await notifier.deliver(
+                Notification(chat_id, text) for _, chat_id, text, _ in rows)
+            sent_ids, retries = [], []
+            for (outbox_id, chat_id, _, attempts), is_delivered in zip(rows, results):
+                if is_delivered:
+                    sent_ids.append(outbox_id)
+                elif attempts + 1 < MAX_ATTEMPTS:
+                    retries.append((outbox_id, now + retry_delay(attempts)))
+                else:
+                    logging.warning('Giving up on outbox notification %s to %s',
+                                    outbox_id, chat_id)
+                    retries.append((outbox_id, None))
+            await async_db.finish_outbox(sent_ids, retries)
+            delivered += report.delivered
+            retried += report.retried
+            failed += report.failed
+            if len(rows) < BATCH_SIZE:
+                break
+        return Report(delivered, retried, failed)
+
+    async def visit(self) -> Optional[int]:
+        await self.drain()
+        return await async_db.next_outbox_attempt()
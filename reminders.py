@@ -0,0 +1,77 @@
+"""Reminder scheduler.
+
+Reminders are rows of the reminders table, created by booking and removed
+by cancelling or deleting the session. The scheduler keeps their due times
+in a priority queue and sleeps exactly until the next one. Entries of
+removed reminders are dropped lazily: claiming them fails when they're due,
+reminder ids are never handed out again.
+One scheduler serves all tenants, the entries remember their tenant."""
+
+import asyncio
+import heapq
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable, List, Tuple
+
+import appointment
+import async_db
+import clock
+import metrics
+import tenants
+
+
+class ReminderScheduler:
+    def __init__(self):
+        # (due time, tenant key, reminder id)
+        self._queue: List[Tuple[int, str, int]] = []
+        self._changed = asyncio.Event()
+
+    def add(self, reminders: Iterable[Tuple[int, int]]) -> None:
+        """Schedules (reminder id, due time) entries of the current tenant"""
+        tenant_key = tenants.current().key
+        for reminder_id, due_at in reminders:
+            heapq.heappush(self._queue, (due_at, tenant_key, reminder_id))
+        self._changed.set()
+
+    async def load(self) -> None:
+        """Fills the queue with the reminders that are not sent yet"""
+        queue = []
+        for tenant in tenants.all_tenants():
+            with tenants.use(tenant):
+                queue.extend((due_at, tenant.key, reminder_id) for due_at, reminder_id
+                             in await async_db.get_pending_reminders())
+        heapq.heapify(queue)
+        self._queue = queue
+        self._changed.set()
+
+    async def run_due(self, send: Callable[[List[appointment.Reminder]], Awaitable]) -> int:
+        """Sends the reminders that are due, in one batch per tenant,
+        returns how many were sent"""
+        due_ids = OrderedDict()
+        now = clock.now_epoch()
+        while self._queue and self._queue[0][0] <= now:
+            due_at, tenant_key, reminder_id = heapq.heappop(self._queue)
+            due_ids.setdefault(tenant_key, []).append(reminder_id)
+        sent = 0
+        for tenant_key, reminder_ids in due_ids.items():
+            with tenants.use(tenants.get(tenant_key)):
+                due_reminders = []
+                for reminder_id in reminder_ids:
+                    reminder = await async_db.take_reminder(reminder_id)
+                    if reminder:
+                        due_reminders.append(reminder)
+                if due_reminders:
+                    await send(due_reminders)
+            sent += len(due_reminders)
+        return sent
+
+    async def run(self, send: Callable[[List[appointment.Reminder]], Awaitable]) -> None:
+        await self.load()
+        while True:
+            self._changed.clear()
+            with metrics.loop_seconds.time('reminders'):
+                await self.run_due(send)
+            timeout = self._queue[0][0] - clock.now_epoch() if self._queue else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
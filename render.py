@@ -0,0 +1,42 @@
+"""Cache of rendered timeline text and keyboards.
+
+Entries are kept per kind and day together with the data version of the
+day from the availability index. A write changes the version of the days
+it touches only, so the other days are reused as they are. Every tenant
+has its own cache."""
+
+import threading
+from typing import Any, Callable, Dict, Hashable, Iterable, Tuple
+
+import tenants
+
+
+class RenderCache:
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str], Tuple[Hashable, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, day: str, version: Hashable, build: Callable[[], Any]) -> Any:
+        """Returns the cached value for the day, built again if the version changed"""
+        entry = self._entries.get((kind, day))
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        value = build()
+        with self._lock:
+            self._entries[(kind, day)] = (version, value)
+        return value
+
+    def retain(self, days: Iterable[str]) -> None:
+        """Drops the entries of the days that are not in the timeline anymore"""
+        days = set(days)
+        with self._lock:
+            for key in [key for key in self._entries if key[1] not in days]:
+                del self._entries[key]
+
+
+_caches = tenants.TenantResource(lambda tenant: RenderCache())
+
+
+def get_cache() -> RenderCache:
+    """The cache of the current tenant"""
+    return _caches.get()
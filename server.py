@@ -1,25 +1,163 @@
 """Controller file"""
 
 import logging
+import bisect
+import cProfile
+import functools
+import hashlib
+import hmac
+import io
 import os
 import asyncio
+import time
+from typing import Dict, List
+
 from aiogram import Bot, Dispatcher, executor, types
-from datetime import datetime
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiogram.utils.exceptions import MessageNotModified
+from aiohttp import web
 
 import appointment
+import async_db
+import callbacks
+import db
 import exceptions
+import holds
+import ical
+import metrics
+import outbox
+import reminders
+import render
+import tenants
+from notifier import Notification, Notifier
 
 logging.basicConfig(level=logging.INFO)
 
-API_TOKEN = os.getenv("API_TOKEN")
-ADMIN_ID = os.getenv("ADMIN_ID")
-
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(bot)
+# 'polling' or 'webhook'
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# public https://host[:port] Telegram sends the updates to
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
+# secret of the webhook path when there is one tenant,
+# otherwise every tenant's secret is derived from its token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 turns the /metrics endpoint off
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9102))
+# handler label (see handler_label) whose next update is profiled, like /timeline
+PROFILE_HANDLER = os.getenv("PROFILE_HANDLER")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+JANITOR_INTERVAL = 600
+DAYS_PER_PAGE = 6
+# commands that get their own label in the metrics
+COMMANDS = ('start', 'help', 'about', 'address', 'price', 'timeline', 'delete',
+            'stats', 'export', 'calendar', 'book_session', 'cancel_session', 'waitlist')
+
+_bots: Dict[str, Bot] = {}
+_notifiers: Dict[str, Notifier] = {}
+
+
+def tenant_bot(tenant: tenants.Tenant) -> Bot:
+    bot = _bots.get(tenant.key)
+    if bot is None:
+        bot = _bots[tenant.key] = Bot(token=tenant.token)
+        bot['tenant'] = tenant
+    return bot
+
+
+def notifier_for(tenant: tenants.Tenant) -> Notifier:
+    """Every bot has its own rate limits"""
+    notifier = _notifiers.get(tenant.key)
+    if notifier is None:
+        notifier = _notifiers[tenant.key] = Notifier(tenant_bot(tenant))
+    return notifier
+
+
+def webhook_secret(tenant: tenants.Tenant) -> str:
+    if WEBHOOK_SECRET and len(tenants.all_tenants()) == 1:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(tenant.token.encode()).hexdigest()[:32]
+
+
+class TenantMiddleware(BaseMiddleware):
+    """Makes the tenant of the bot that got the update current
+    while the update is handled"""
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data['tenant_token'] = tenants.activate(Bot.get_current()['tenant'])
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        tenants.deactivate(data.pop('tenant_token'))
+
+
+def handler_label(update: types.Update) -> str:
+    """Command or callback action of the update, for the metrics"""
+    if update.callback_query:
+        payload = callbacks.decode(update.callback_query.data or '')
+        return f'callback:{type(payload).__name__.lower() if payload else "unknown"}'
+    if update.message:
+        command = update.message.get_command(pure=True)
+        if command in COMMANDS:
+            return f'/{command}'
+        return 'text' if update.message.text else 'other'
+    return 'other'
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Records how long every update took to handle"""
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data['started'] = time.perf_counter()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        metrics.handler_seconds.observe(time.perf_counter() - data.pop('started'),
+                                        handler_label(update))
+
+
+class ProfileMiddleware(BaseMiddleware):
+    """Profiles the first update of PROFILE_HANDLER with cProfile and saves
+    the stats to PROFILE_DIR. Only the event loop thread is profiled,
+    the queries run in the database threads and go to the slow query log."""
+
+    def __init__(self, handler: str):
+        super().__init__()
+        self.handler = handler
+        self.profile = None
+        self.done = False
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if self.done or self.profile or handler_label(update) != self.handler:
+            return
+        self.profile = data['profile'] = cProfile.Profile()
+        self.profile.enable()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        profile = data.pop('profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        self.profile, self.done = None, True
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = self.handler.strip('/').replace(':', '-')
+        path = os.path.join(PROFILE_DIR, f'{name}-{int(time.time())}.prof')
+        profile.dump_stats(path)
+        logging.info('Profile of %s saved to %s', self.handler, path)
+
+
+dp = Dispatcher(tenant_bot(tenants.all_tenants()[0]))
+dp.middleware.setup(TenantMiddleware())
+dp.middleware.setup(MetricsMiddleware())
+if PROFILE_HANDLER:
+    dp.middleware.setup(ProfileMiddleware(PROFILE_HANDLER))
+reminder_scheduler = reminders.ReminderScheduler()
+outbox_worker = outbox.OutboxWorker(notifier_for)
+hold_keeper = holds.HoldKeeper(outbox_worker.wake)
 
 
 def access_id(user_id: int) -> bool:
-    if user_id == ADMIN_ID:
+    if user_id == tenants.current().admin_id:
         return True
     return False
 
@@ -51,7 +189,8 @@ async def send_welcome(message: types.Message):
 async def helper(message: types.Message):
     if access_id(message.from_user.id):
         await message.answer('Commands:'
-                             '\n\n/book_session - Displays a list of available sessions; '
+                             '\n\n/book_session - Displays the days with available sessions, choose a day '
+                             'to see its sessions; '
                              'by selecting one, you book that session. The wizard receives '
                              'a notification of your appointment, your name on the Telegram, '
                              'and a link to your profile to contact you. You can only book for 1 '
@@ -76,14 +215,26 @@ async def helper(message: types.Message):
                              "available. Next is the session time. If the session is booked, "
                              "it is followed by the client's name, a link to their profile, "
                              "and the reservation time."
-                             "\n\n/delete - Displays a list of all sessions for deletion. "
-                             "Clicking on a session deletes it. You can also delete an entire "
+                             "\n\n/delete - Displays the days of the timeline, choose a day to see "
+                             "its sessions for deletion. Clicking on a session deletes it. You can also delete an entire "
                              "day with the corresponding button. If the session has been booked, "
                              "the client will receive a notification to cancel the session. "
+                             "\n\n/stats - Shows the sessions opened, booked, cancelled and "
+                             "deleted, bookings by weekday and the busiest hours. Without dates "
+                             "it covers 30 days before and after today, or give the first and "
+                             "the last day: /stats 01.04 30.04"
+                             "\n\n/export - Sends all the sessions, the archived ones too, as a "
+                             "CSV file for a spreadsheet. Give the first and the last day to "
+                             "export only these days: /export 01.04 30.04"
+                             "\n\n/calendar - Sends the timeline as an .ics file to import into "
+                             "a calendar app. In webhook mode the message has the URL of a feed "
+                             "that calendar apps can subscribe to."
                              "\n\n\nAdding new sessions - You must enter the date and the list "
                              "of sessions in the format: 12.05 8 9:30 12 14:30 16, where 12.05 - "
                              "date, and then the time of the sessions, separated by a space. After "
-                             "sending to the bot, these sessions will be available for booking."
+                             "sending to the bot, these sessions will be available for booking. "
+                             "Several days can be added in one message, one day per line. "
+                             "Sessions that are already in the timeline are skipped."
                              "\n\nPrice update - You need to enter the keyword 'price', and then "
                              "after the space 3 prices, in the format: price 99 55 33. Where "
                              "service 1 - 99, service 2 - 55, service 3 - 33. The number of prices "
@@ -100,7 +251,8 @@ async def helper(message: types.Message):
                              "the information about the wizard is updated.")
     else:
         await message.answer('Commands:'
-                             '\n\n/book_session - Displays a list of available sessions; '
+                             '\n\n/book_session - Displays the days with available sessions, choose a day '
+                             'to see its sessions; '
                              'by selecting one, you book that session. The wizard receives '
                              'a notification of your appointment, your name on the Telegram, '
                              'and a link to your profile to contact you. You can only book for 1 '
@@ -116,23 +268,29 @@ async def helper(message: types.Message):
                              '\n\n/address - Shows the address where the wizard performs '
                              'his services'
                              '\n\n/about - Shows information about wizard. '
+                             '\n\n/calendar - Sends your booked session as an .ics file to add '
+                             'it to your calendar.'
+                             '\n\n/waitlist - When no session is free, join the waitlist of any '
+                             'session, or of a day: /waitlist 05.04. When a session frees up you '
+                             'get a message and it is held for you for a few minutes. '
+                             '/waitlist leave takes you off the waitlist.'
                              '\n\nThe bot sends the client two reminders: about a day before the '
                              'session and a few hours before.')
 
 
 @dp.message_handler(commands=['about'])
 async def get_about_master(message: types.Message):
-    await message.answer(appointment.get_about())
+    await message.answer(await async_db.get_about())
 
 
 @dp.message_handler(commands=['address'])
 async def get_address(message: types.Message):
-    await message.answer(appointment.get_address())
+    await message.answer(await async_db.get_address())
 
 
 @dp.message_handler(commands=['price'])
 async def get_price(message: types.Message):
-    price1, price2, price3 = appointment.get_price()
+    price1, price2, price3 = await async_db.get_price()
     message_answer = f"<b>- PRICE LIST -</b>\n" \
                      f"\n- Price 1: <b>{price1}</b> PLN" \
                      f"\n- Price 2: <b>{price2}</b> PLN" \
@@ -144,7 +302,39 @@ async def get_price(message: types.Message):
 async def view_timeline(message: types.Message):
     """Only for admin"""
     if access_id(message.from_user.id):
-        await message.answer(appointment.get_timeline(), parse_mode='html')
+        await message.answer(await async_db.get_timeline(), parse_mode='html')
+    else:
+        await message.answer('<b>Unknown command</b>', parse_mode='html')
+
+
+@dp.message_handler(commands=['stats'])
+async def view_stats(message: types.Message):
+    """Only for admin"""
+    if access_id(message.from_user.id):
+        try:
+            await message.answer(await async_db.stats_report(message.get_args() or ''),
+                                 parse_mode='html')
+        except exceptions.NotCorrectMessage as e:
+            await message.answer(str(e))
+    else:
+        await message.answer('<b>Unknown command</b>', parse_mode='html')
+
+
+@dp.message_handler(commands=['export'])
+async def export_sessions(message: types.Message):
+    """Only for admin"""
+    if access_id(message.from_user.id):
+        try:
+            file, name, count = await async_db.export_sessions(message.get_args() or '')
+        except exceptions.NotCorrectMessage as e:
+            await message.answer(str(e))
+            return
+        with file:
+            if count:
+                await message.answer_document(types.InputFile(file, filename=name),
+                                              caption=f'Sessions: {count}')
+            else:
+                await message.answer('No sessions in these days')
     else:
         await message.answer('<b>Unknown command</b>', parse_mode='html')
 
@@ -153,37 +343,10 @@ async def view_timeline(message: types.Message):
 async def del_from_timeline(message: types.Message):
     """Only for admin"""
     if access_id(message.from_user.id):
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        sessions = appointment.get_all_sessions()
+        sessions = await async_db.get_all_sessions()
         if sessions:
-            await message.answer("Choose a session to remove:", parse_mode='html')
-            markup_rows = 2
-            for day, times in sessions.items():
-                buttons_added = []
-                users_id = ''
-                for time in times:
-                    # id, available, session_time, customer_name, customer_username,
-                    # updated, customer_user_id
-                    if time[1] == '✖️':
-                        users_id += f'{time[6]} '
-                    item = types.InlineKeyboardButton(f'{time[2][:5]} {time[1]}',
-                                                      callback_data=
-                                                      f'{time[0]} {day} {time[2][:5]} '
-                                                      f'{time[6]} {time[4]} del')
-
-                    buttons_added.append(item)
-                    if len(buttons_added) == markup_rows:
-                        markup.add(*buttons_added)
-                        buttons_added = []
-                if buttons_added:
-                    markup.add(buttons_added[0])
-                item = types.InlineKeyboardButton('Delete all day',
-                                                  callback_data=f'{str(day)} {users_id} del_all')
-                markup.add(item)
-                about_day = appointment.day_format(day)
-                message_answer = f'{about_day.day_of_week} <b>{about_day.date}</b>'
-                await message.answer(message_answer, reply_markup=markup, parse_mode='html')
-                markup = types.InlineKeyboardMarkup(row_width=2)
+            await message.answer("Choose a day to remove sessions from:",
+                                 reply_markup=render_days_page(list(sessions), 0, 'del'))
         else:
             await message.answer('Timeline is empty')
 
@@ -191,47 +354,214 @@ async def del_from_timeline(message: types.Message):
         await message.answer('<b>Unknown command</b>', parse_mode='html')
 
 
+def render_delete_day(day: str, times: list) -> tuple:
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup_rows = 2
+    buttons_added = []
+    for time in times:
+        # id, available, session_time, customer_name, customer_username,
+        # updated, customer_user_id
+        item = callbacks.button(f'{time[2][:5]} {time[1]}', callbacks.Delete(time[0]))
+
+        buttons_added.append(item)
+        if len(buttons_added) == markup_rows:
+            markup.add(*buttons_added)
+            buttons_added = []
+    if buttons_added:
+        markup.add(buttons_added[0])
+    item = callbacks.button('Delete all day', callbacks.DeleteAll(day))
+    markup.add(item)
+    markup.add(callbacks.button('⬅️ Back', callbacks.Back('del', day)))
+    about_day = appointment.day_format(day)
+    message_answer = f'{about_day.day_of_week} <b>{about_day.date}</b>'
+    return message_answer, markup
+
+
+def get_user_fullname(user: types.User) -> str:
+    user_fullname = user.first_name
+    if user.last_name:
+        user_fullname += f'-{user.last_name}'
+    return user_fullname
+
+
 @dp.message_handler(commands=['book_session'])
 async def book_session(message):
-    appointment.refresh_db()
     if message.from_user.username is not None:
-        user_fullname = message.from_user.first_name
-        if message.from_user.last_name:
-            user_fullname += f'-{message.from_user.last_name}'
-        markup_rows = 2
-        sessions = appointment.get_available_sessions()
+        sessions = await async_db.get_available_sessions(message.from_user.id)
         if sessions:
-            markup = types.InlineKeyboardMarkup(row_width=2)
-            await message.answer('Choose a session:')
-            for day, times in sessions.items():
-                buttons_added = []
-                about_day = appointment.day_format(day)
-                # time, id
-                for time in times:
-                    item = types.InlineKeyboardButton(f'{time[0][:5]}',
-                                                      callback_data=f'{time[1]} '
-                                                                    f'{user_fullname} {day} {time[0]} book')
-                    buttons_added.append(item)
-                    if len(buttons_added) == markup_rows:
-                        markup.add(*buttons_added)
-                        buttons_added = []
-                if buttons_added:
-                    markup.add(buttons_added[0])
-                message_answer = f'{about_day.day_of_week} {about_day.date}'
-                await message.answer(message_answer, reply_markup=markup)
-                markup = types.InlineKeyboardMarkup(row_width=2)
+            await message.answer('Choose a day:',
+                                 reply_markup=render_days_page(list(sessions), 0, 'book'))
         else:
-            await message.answer('No sessions available')
+            await message.answer('No sessions available', reply_markup=render_join_waitlist())
     else:
         await message.answer("❗️You can't book a session because you don't have a username. "
                              "Get a username so that we can give the master a link to your "
                              "account, and then come back :)")
 
 
+def render_join_waitlist() -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup()
+    markup.add(callbacks.button('Join the waitlist', callbacks.JoinWaitlist()))
+    return markup
+
+
+def render_book_day(day: str, times: list) -> tuple:
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup_rows = 2
+    buttons_added = []
+    about_day = appointment.day_format(day)
+    # time, id
+    for time in times:
+        item = callbacks.button(f'{time[0][:5]}', callbacks.Book(time[1]))
+        buttons_added.append(item)
+        if len(buttons_added) == markup_rows:
+            markup.add(*buttons_added)
+            buttons_added = []
+    if buttons_added:
+        markup.add(buttons_added[0])
+    markup.add(callbacks.button('⬅️ Back', callbacks.Back('book', day)))
+    message_answer = f'{about_day.day_of_week} {about_day.date}'
+    return message_answer, markup
+
+
+def render_days_page(days: list, page: int, action: str) -> types.InlineKeyboardMarkup:
+    """Keyboard with one page of days and the buttons to turn pages.
+    action is 'book' or 'del'."""
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    for day in days[page * DAYS_PER_PAGE:(page + 1) * DAYS_PER_PAGE]:
+        about_day = appointment.day_format(day)
+        buttons.append(callbacks.button(
+            f'{about_day.day_of_week[:3]} {about_day.date[:5]}',
+            callbacks.ShowDay(action, day)))
+    markup.add(*buttons)
+    navigation = []
+    if page > 0:
+        navigation.append(callbacks.button('◀️', callbacks.Page(action, page - 1)))
+    if (page + 1) * DAYS_PER_PAGE < len(days):
+        navigation.append(callbacks.button('▶️', callbacks.Page(action, page + 1)))
+    if navigation:
+        markup.row(*navigation)
+    return markup
+
+
+async def get_picker_sessions(action: str, user_id: int):
+    if action == 'book':
+        return await async_db.get_available_sessions(user_id)
+    return await async_db.get_all_sessions()
+
+
+async def edit_picker(call, text: str, markup, **kwargs) -> None:
+    """Turns the picker message to the text and keyboard.
+    A repeated tap changes nothing, Telegram refuses that edit."""
+    try:
+        await call.bot.edit_message_text(text, chat_id=call.message.chat.id,
+                                         message_id=call.message.message_id,
+                                         reply_markup=markup, **kwargs)
+    except MessageNotModified:
+        pass
+
+
+async def show_days_page(call, action: str, page: int = 0, day: str = None) -> None:
+    """Turns the picker message to a page of days.
+    With day, to the page where the day is."""
+    sessions = await get_picker_sessions(action, call.from_user.id)
+    if not sessions:
+        if action == 'book':
+            text, markup = 'No sessions available', render_join_waitlist()
+        else:
+            text, markup = 'Timeline is empty', None
+        await edit_picker(call, text, markup)
+        return
+    days = list(sessions)
+    if day is not None:
+        page = bisect.bisect_left(days, day) // DAYS_PER_PAGE
+    page = min(max(page, 0), (len(days) - 1) // DAYS_PER_PAGE)
+    text = 'Choose a day:' if action == 'book' else 'Choose a day to remove sessions from:'
+    await edit_picker(call, text, render_days_page(days, page, action))
+
+
+async def show_day(call, action: str, day: str) -> None:
+    """Turns the picker message to the sessions of the day"""
+    versions = await async_db.get_day_versions()
+    sessions = await get_picker_sessions(action, call.from_user.id)
+    if not sessions or day not in sessions:
+        await show_days_page(call, action, day=day)
+        return
+    times = sessions[day]
+    if action == 'book':
+        # past sessions and the ones held for other clients are left
+        # out, so the ids tell which of the day's sessions are shown
+        message_answer, markup = render.get_cache().get(
+            'book', day, (versions.get(day), tuple(session_id for _, session_id in times)),
+            functools.partial(render_book_day, day, times))
+    else:
+        message_answer, markup = render.get_cache().get(
+            'delete', day, versions.get(day),
+            functools.partial(render_delete_day, day, times))
+    await edit_picker(call, message_answer, markup, parse_mode='html')
+
+
+@dp.message_handler(commands=['calendar'])
+async def send_calendar(message: types.Message):
+    """The admin gets the whole timeline as an .ics file, a client their
+    booked session. In webhook mode the caption has the URL of the feed
+    for subscribing in a calendar app."""
+    if access_id(message.from_user.id):
+        feed, owner, filename = await async_db.master_feed(), 'master', 'sessions.ics'
+    elif await async_db.check_client_in_db(message.from_user.id):
+        owner = str(message.from_user.id)
+        feed, filename = await async_db.client_feed(message.from_user.id), 'session.ics'
+    else:
+        await message.answer('You have no booked session')
+        return
+    caption = None
+    if BOT_MODE == 'webhook' and WEBHOOK_HOST:
+        caption = f'Calendar feed: {WEBHOOK_HOST}{ical.feed_path(tenants.current(), owner)}'
+    await message.answer_document(types.InputFile(io.BytesIO(feed.body), filename=filename),
+                                  caption=caption)
+
+
+@dp.message_handler(commands=['waitlist'])
+async def waitlist(message: types.Message):
+    """/waitlist [DD.MM] joins the waitlist of any session or of the day,
+    /waitlist leave leaves it"""
+    if access_id(message.from_user.id):
+        await message.answer('The waitlist is for clients, you can book any session')
+        return
+    args = (message.get_args() or '').strip()
+    if args.lower() == 'leave':
+        if await async_db.leave_waitlist(message.from_user.id):
+            outbox_worker.wake()
+            hold_keeper.wake()
+            await message.answer('You left the waitlist')
+        else:
+            await message.answer('You are not on the waitlist')
+        return
+    await message.answer(await join_waitlist(message.from_user, args))
+
+
+async def join_waitlist(user: types.User, raw_day: str) -> str:
+    """Puts the client on the waitlist, returns the answer"""
+    if user.username is None:
+        return ("❗️You can't join the waitlist because you don't have a username. "
+                "Get a username so that you can book a session, and then come back :)")
+    if await async_db.check_client_in_db(user.id):
+        return "You are already booked for a session, cancel it first to wait for another"
+    try:
+        if not await async_db.join_waitlist(user.id, raw_day):
+            return 'You are already on this waitlist'
+    except exceptions.NotCorrectMessage as e:
+        return str(e)
+    return (f'You are on the waitlist. When a session frees up you get a message and it is '
+            f'held for you for {db.WAITLIST_HOLD // 60} minutes. '
+            f'/waitlist leave takes you off the waitlist.')
+
+
 @dp.message_handler(commands=['cancel_session'])
 async def cancel_session(message):
     if access_id(message.from_user.id):
-        sessions = appointment.get_booked_sessions()
+        sessions = await async_db.get_booked_sessions()
         markup = types.InlineKeyboardMarkup(row_width=1)
         if sessions:
             await message.answer('Choose a session to cancel:')
@@ -239,10 +569,8 @@ async def cancel_session(message):
             for day, times in sessions.items():
                 about_day = appointment.day_format(day)
                 for time in times:
-                    item = types.InlineKeyboardButton(
-                        f"{time[1][:5]} @{time[3]}",
-                        callback_data=f"{time[0]} {day} {time[1][:5]} "
-                                      f"{time[2]} {time[3]} cancel")
+                    item = callbacks.button(f"{time[1][:5]} @{time[3]}",
+                                            callbacks.Cancel(time[0]))
                     markup.add(item)
                 message_answer = f"{about_day.day_of_week} {about_day.date}"
                 await message.answer(message_answer, reply_markup=markup)
@@ -251,15 +579,12 @@ async def cancel_session(message):
         else:
             await message.answer('No booked sessions')
     else:
-        session = appointment.check_client_in_db(message.from_user.id)
+        session = await async_db.check_client_in_db(message.from_user.id)
         if session:
             markup = types.InlineKeyboardMarkup(row_width=1)
             session_id, day, session_time = session
             about_day = appointment.day_format(day)
-            item = types.InlineKeyboardButton("Confirm canceling",
-                                              callback_data=f"{session_id} "
-                                                            f"{day} {session_time[:5]} "
-                                                            f"cancel")
+            item = callbacks.button("Confirm canceling", callbacks.Cancel(session_id))
             markup.add(item)
             message_answer = \
                 f"Confirm session cancellation for " \
@@ -277,208 +602,390 @@ async def text_reader(message):
         text_input = message.text.lower()
         if text_input.startswith('price'):
             try:
-                appointment.change_price(message.text)
+                await async_db.change_price(message.text)
                 await message.answer('Ok, changes applied.')
             except exceptions.NotCorrectMessage as e:
                 await message.answer(str(e))
 
         elif text_input.startswith('local'):
             try:
-                appointment.change_address(message.text)
+                await async_db.change_address(message.text)
                 await message.answer('Ok, changes applied.')
             except exceptions.NotCorrectMessage as e:
                 await message.answer(str(e))
 
         elif text_input.startswith('info'):
             try:
-                appointment.change_info(message.text)
+                await async_db.change_info(message.text)
                 await message.answer('Ok, changes applied.')
             except exceptions.NotCorrectMessage as e:
                 await message.answer(str(e))
         else:
-            await message.answer(appointment.create_sessions(text_input), parse_mode='html')
+            await message.answer(await async_db.create_sessions(text_input), parse_mode='html')
+            # the new sessions may have been offered to the waitlist
+            outbox_worker.wake()
+            hold_keeper.wake()
     else:
         await message.answer('<b>Unknown command</b>', parse_mode='html')
 
 
+router = callbacks.CallbackRouter()
+
+
 @dp.callback_query_handler(lambda call: True)
 async def callback_inline(call):
+    """Runs the handler of the button. The query is answered in any
+    case, otherwise the app shows a spinner until Telegram times out."""
     try:
         if call.message:
-            if call.data.endswith('del'):
-                session_id, day, time = call.data.split()[:3]
-                about_day = appointment.day_format(day)
-                if len(call.data.split()) == 6:
-
-                    user_id, username = call.data.split()[3:5]
-                    if int(user_id) != ADMIN_ID:
-                        await bot.send_message(call.from_user.id,
-                                               f"@{username} session for "
-                                               f"{about_day.day_of_week}, "
-                                               f"{about_day.date} at {time} "
-                                               f"is cancelled, notice was sent.")
-                        try:
-                            await bot.send_message(int(user_id), f'Your session for '
-                                                                 f'{about_day.day_of_week}, '
-                                                                 f'{about_day.date} at {time} '
-                                                                 f'has been deleted by the admin, '
-                                                                 f'you can contact the master for '
-                                                                 f'details:\n@masterslink')
-                        except Exception:
-                            print('Error send message to user about delete a him session')
-
-                session_id = int(session_id)
-                appointment.delete_session(session_id)
-                await bot.send_message(call.from_user.id,
-                                       f'Deleted session for {about_day.day_of_week}, '
-                                       f'{about_day.date} at {time}')
-            elif call.data.endswith('del_all'):
-                day = call.data.split()[0]
-                about_day = appointment.day_format(day)
-                if len(call.data.split()) > 2:
-                    users_id = call.data.split()[1:-1]
-                    for user_id in users_id:
-                        if int(user_id) != ADMIN_ID:
-                            try:
-                                await bot.send_message(int(user_id), f"Your session for "
-                                                                     f"{about_day.day_of_week}, "
-                                                                     f"{about_day.date} has been "
-                                                                     f"deleted by the admin, you "
-                                                                     f"can contact the master "
-                                                                     f"for details:\n@masterslink")
-                            except Exception:
-                                print(f'Error send message to user {users_id} '
-                                      f'about delete him session day')
-                appointment.delete_day(day)
-
-                await bot.send_message(call.from_user.id,
-                                       f'Deleted all sessions for {about_day.day_of_week}, '
-                                       f'{about_day.date}')
-            elif call.data.endswith('book'):
-                session_id, user_fullname, day, time = call.data.split()[:4]
-                about_day, address = appointment.day_format(day), appointment.get_address()
-                if access_id(call.from_user.id):
-                    appointment.booking_session(int(session_id), int(call.from_user.id),
-                                                call.from_user.username, user_fullname)
-                    await bot.send_message(call.from_user.id,
-                                           f'Reservations for {about_day.day_of_week}, '
-                                           f'{about_day.date} at {time[:5]}')
-                else:
-                    session = appointment.check_client_in_db(int(call.from_user.id))
-                    # id date time
-                    if session:
-                        user_session_date = session[1]
-                        about_day = appointment.day_format(str(user_session_date))
-                        user_session_time = session[2]
-                        await bot.edit_message_text(chat_id=call.from_user.id,
-                                                    message_id=call.message.message_id,
-                                                    text=f"You are already booked for "
-                                                         f"{about_day.day_of_week}, "
-                                                         f"{about_day.date} at {user_session_time[:5]}. "
-                                                         f"To change your session, first cancel "
-                                                         f"the existing.",
-                                                    reply_markup=None)
-                    else:
-                        appointment.booking_session(int(session_id), int(call.from_user.id),
-                                                    call.from_user.username, user_fullname)
-                        await bot.edit_message_text(chat_id=call.from_user.id,
-                                                    message_id=call.message.message_id,
-                                                    text=f"Reservations for "
-                                                         f"{about_day.day_of_week}, "
-                                                         f"{about_day.date} at "
-                                                         f"{time[:5]}"
-                                                         f"\nName: {user_fullname}"
-                                                         f"\nAcc: @{call.from_user.username}"
-                                                         f"\nAddress: {address}\n"
-                                                         f"\nSee you :)",
-                                                    reply_markup=None)
-                        try:
-                            await bot.send_message(ADMIN_ID, f'{user_fullname} '
-                                                         f'booked for {about_day.day_of_week}, '
-                                                         f'{about_day.date} at {time[0:5]}\n'
-                                                         f'Acc: @{call.from_user.username}')
-                        except Exception:
-                            print('Error send message to Admin about booking session')
-            elif call.data.endswith('cancel'):
-                session_id, day, session_time = call.data.split()[:3]
-                about_day = appointment.day_format(day)
-                if access_id(call.from_user.id):
-                    user_id, username = call.data.split()[3:5]
-                    if int(user_id) != ADMIN_ID:
-                        try:
-                            await bot.send_message(int(user_id),
-                                                   f"Your session on "
-                                                   f"{about_day.day_of_week}, "
-                                                   f"{about_day.date} at {session_time} "
-                                                   f"was cancelled by the admin, please "
-                                                   f"contact the master for details:"
-                                                   f"\n@masterslink")
-                        except Exception:
-                            print('Error send message to user about canceled him session')
-
-                    await bot.send_message(call.from_user.id,
-                                           f"@{username}'s session on "
-                                           f"{about_day.day_of_week}, "
-                                           f"{about_day.date} at {session_time} "
-                                           f"has been canceled")
-
-                else:
-                    try:
-                        await bot.send_message(ADMIN_ID,
-                                               f"@{call.from_user.username} "
-                                               f"cancelled his session for "
-                                               f"{about_day.day_of_week}, "
-                                               f"{about_day.date} at {session_time}")
-                    except Exception:
-                        print('Error send message to admin about user canceling session')
-                    await bot.edit_message_text(chat_id=call.from_user.id,
-                                                message_id=call.message.message_id,
-                                                text=f"Your session for "
-                                                     f"{about_day.day_of_week}, "
-                                                     f"{about_day.date} at "
-                                                     f"{session_time} is cancelled",
-                                                reply_markup=None)
-                appointment.cancel_session(int(session_id))
-                print(call.data.split())
-    except Exception as e:
-        print(repr(e))
+            if not await router.dispatch(call):
+                await call.bot.edit_message_text('This button has expired, send the command again',
+                                                 chat_id=call.message.chat.id,
+                                                 message_id=call.message.message_id,
+                                                 reply_markup=None)
+    finally:
+        await call.answer()
+
+
+@dp.errors_handler()
+async def errors_handler(update: types.Update, exception: Exception) -> bool:
+    """Counts and logs the errors of the handlers, the bot keeps running"""
+    metrics.handler_errors.inc(handler_label(update))
+    logging.error('Error handling update %s: %r', update.update_id, exception,
+                  exc_info=exception)
+    return True
+
+
+def picker_allowed(call, picker: str) -> bool:
+    """Callback data can be forged: the picker must be 'book', or 'del' for admin"""
+    return picker == 'book' or (picker == 'del' and access_id(call.from_user.id))
+
+
+@router.handler(callbacks.Page)
+async def on_page(call, payload: callbacks.Page):
+    if not picker_allowed(call, payload.picker):
+        return
+    await show_days_page(call, payload.picker, page=payload.page)
+
+
+@router.handler(callbacks.ShowDay)
+async def on_show_day(call, payload: callbacks.ShowDay):
+    if not picker_allowed(call, payload.picker):
+        return
+    await show_day(call, payload.picker, payload.day)
+
+
+@router.handler(callbacks.Back)
+async def on_back(call, payload: callbacks.Back):
+    if not picker_allowed(call, payload.picker):
+        return
+    await show_days_page(call, payload.picker, day=payload.day)
+
+
+@router.handler(callbacks.Delete)
+async def on_delete(call, payload: callbacks.Delete):
+    """Only for admin"""
+    if not access_id(call.from_user.id):
+        return
+    session = await async_db.get_session(payload.session_id)
+    if session is None:
+        await call.bot.send_message(call.from_user.id, 'The session is already deleted')
+        return
+    day, time = session.session_date, session.session_time[:5]
+    about_day = appointment.day_format(day)
+    notifications = []
+    if not session.available and session.customer_user_id != tenants.current().admin_id:
+        notifications.append((session.customer_user_id, f'Your session for '
+                                                        f'{about_day.day_of_week}, '
+                                                        f'{about_day.date} at {time} '
+                                                        f'has been deleted by the admin, '
+                                                        f'you can contact the master for '
+                                                        f'details:\n@masterslink'))
+    await async_db.delete_session(session.id, notifications)
+    outbox_worker.wake()
+    if notifications:
+        await call.bot.send_message(call.from_user.id,
+                                    f"@{session.customer_username} session for "
+                                    f"{about_day.day_of_week}, "
+                                    f"{about_day.date} at {time} "
+                                    f"is cancelled, notice was sent.")
+    await call.bot.send_message(call.from_user.id,
+                                f'Deleted session for {about_day.day_of_week}, '
+                                f'{about_day.date} at {time}')
+    await show_day(call, 'del', day)
+
+
+@router.handler(callbacks.DeleteAll)
+async def on_delete_all(call, payload: callbacks.DeleteAll):
+    """Only for admin"""
+    if not access_id(call.from_user.id):
+        return
+    day = payload.day
+    about_day = appointment.day_format(day)
+    sessions = await async_db.get_all_sessions()
+    # id, available, session_time, customer_name, customer_username,
+    # updated, customer_user_id
+    users_id = {time[6] for time in (sessions or {}).get(day, []) if time[1] == '✖️'}
+    notifications = [(user_id, f"Your session for "
+                               f"{about_day.day_of_week}, "
+                               f"{about_day.date} has been "
+                               f"deleted by the admin, you "
+                               f"can contact the master "
+                               f"for details:\n@masterslink")
+                     for user_id in users_id if user_id != tenants.current().admin_id]
+    await async_db.delete_day(day, notifications)
+    outbox_worker.wake()
+
+    await call.bot.send_message(call.from_user.id,
+                                f'Deleted all sessions for {about_day.day_of_week}, '
+                                f'{about_day.date}')
+    await show_days_page(call, 'del', day=day)
+
+
+@router.handler(callbacks.Book)
+async def on_book(call, payload: callbacks.Book):
+    session = await async_db.get_session(payload.session_id)
+    if session is None:
+        await call.bot.edit_message_text(chat_id=call.from_user.id,
+                                         message_id=call.message.message_id,
+                                         text="Sorry, the session is not available anymore. "
+                                              "Choose another one with /book_session",
+                                         reply_markup=None)
+        return
+    session_id, day, time = session.id, session.session_date, session.session_time
+    admin_id = tenants.current().admin_id
+    user_fullname = get_user_fullname(call.from_user)
+    about_day, address = appointment.day_format(day), await async_db.get_address()
+    if access_id(call.from_user.id):
+        try:
+            await async_db.booking_session(session_id, int(call.from_user.id),
+                                           call.from_user.username, user_fullname,
+                                           by_admin=True)
+        except exceptions.SessionTaken:
+            await call.bot.send_message(call.from_user.id,
+                                        f'The session for {about_day.day_of_week}, '
+                                        f'{about_day.date} at {time[:5]} is already taken')
+            return
+        await call.bot.send_message(call.from_user.id,
+                                    f'Reservations for {about_day.day_of_week}, '
+                                    f'{about_day.date} at {time[:5]}')
+    else:
+        try:
+            reminder_entries = await async_db.booking_session(
+                session_id, int(call.from_user.id),
+                call.from_user.username, user_fullname,
+                notifications=[(admin_id, f'{user_fullname} '
+                                          f'booked for {about_day.day_of_week}, '
+                                          f'{about_day.date} at {time[0:5]}\n'
+                                          f'Acc: @{call.from_user.username}')])
+        except exceptions.AlreadyBooked:
+            session = await async_db.check_client_in_db(int(call.from_user.id))
+            # id date time
+            user_session_date = session[1]
+            about_day = appointment.day_format(str(user_session_date))
+            user_session_time = session[2]
+            await call.bot.edit_message_text(chat_id=call.from_user.id,
+                                             message_id=call.message.message_id,
+                                             text=f"You are already booked for "
+                                                  f"{about_day.day_of_week}, "
+                                                  f"{about_day.date} at {user_session_time[:5]}. "
+                                                  f"To change your session, first cancel "
+                                                  f"the existing.",
+                                             reply_markup=None)
+            return
+        except exceptions.SessionTaken:
+            await call.bot.edit_message_text(chat_id=call.from_user.id,
+                                             message_id=call.message.message_id,
+                                             text=f"Sorry, the session for "
+                                                  f"{about_day.day_of_week}, "
+                                                  f"{about_day.date} at {time[:5]} "
+                                                  f"has just been taken. Choose another "
+                                                  f"one with /book_session",
+                                             reply_markup=None)
+            return
+        reminder_scheduler.add(reminder_entries)
+        outbox_worker.wake()
+        hold_keeper.wake()
+        await call.bot.edit_message_text(chat_id=call.from_user.id,
+                                         message_id=call.message.message_id,
+                                         text=f"Reservations for "
+                                              f"{about_day.day_of_week}, "
+                                              f"{about_day.date} at "
+                                              f"{time[:5]}"
+                                              f"\nName: {user_fullname}"
+                                              f"\nAcc: @{call.from_user.username}"
+                                              f"\nAddress: {address}\n"
+                                              f"\nSee you :)",
+                                         reply_markup=None)
+
+
+@router.handler(callbacks.JoinWaitlist)
+async def on_join_waitlist(call, payload: callbacks.JoinWaitlist):
+    if access_id(call.from_user.id):
+        text = 'The waitlist is for clients, you can book any session'
+    else:
+        text = await join_waitlist(call.from_user, '')
+    await call.bot.edit_message_text(text, chat_id=call.message.chat.id,
+                                     message_id=call.message.message_id, reply_markup=None)
+
+
+@router.handler(callbacks.Cancel)
+async def on_cancel(call, payload: callbacks.Cancel):
+    session = await async_db.get_session(payload.session_id)
+    admin = access_id(call.from_user.id)
+    if session is None or session.available or \
+            not admin and session.customer_user_id != call.from_user.id:
+        await call.bot.send_message(call.from_user.id, 'The session is not booked anymore')
+        return
+    session_id, day, session_time = session.id, session.session_date, session.session_time[:5]
+    admin_id = tenants.current().admin_id
+    about_day = appointment.day_format(day)
+    if admin:
+        user_id, username = session.customer_user_id, session.customer_username
+        notifications = []
+        if user_id != admin_id:
+            notifications.append((user_id,
+                                  f"Your session on "
+                                  f"{about_day.day_of_week}, "
+                                  f"{about_day.date} at {session_time} "
+                                  f"was cancelled by the admin, please "
+                                  f"contact the master for details:"
+                                  f"\n@masterslink"))
+        await async_db.cancel_session(session_id, notifications)
+        outbox_worker.wake()
+        hold_keeper.wake()
+        await call.bot.send_message(call.from_user.id,
+                                    f"@{username}'s session on "
+                                    f"{about_day.day_of_week}, "
+                                    f"{about_day.date} at {session_time} "
+                                    f"has been canceled")
+
+    else:
+        notifications = [(admin_id, f"@{call.from_user.username} "
+                                    f"cancelled his session for "
+                                    f"{about_day.day_of_week}, "
+                                    f"{about_day.date} at {session_time}")]
+        await async_db.cancel_session(session_id, notifications)
+        outbox_worker.wake()
+        hold_keeper.wake()
+        await call.bot.edit_message_text(chat_id=call.from_user.id,
+                                         message_id=call.message.message_id,
+                                         text=f"Your session for "
+                                              f"{about_day.day_of_week}, "
+                                              f"{about_day.date} at "
+                                              f"{session_time} is cancelled",
+                                         reply_markup=None)
+
+
+async def send_reminders(due_reminders: List[appointment.Reminder]) -> None:
+    tenant = tenants.current()
+    notifications = []
+    for reminder in due_reminders:
+        if reminder.user_id == tenant.admin_id:
+            continue
+        if reminder.kind == 'day':
+            notifications.append(Notification(
+                reminder.user_id, f"Just a reminder about your "
+                                  f"session tomorrow at {reminder.session_time[:5]}"))
+        else:
+            notifications.append(Notification(
+                reminder.user_id, f"I'll wait for you at {reminder.session_time[:5]}, "
+                                  f"tell me if you're going to be late."))
+    report = await notifier_for(tenant).send(notifications)
+    logging.info('Reminders sent for %s: %s', tenant.key, report)
 
 
 async def user_reminder() -> None:
-    while True:
-        sessions = appointment.get_booked_sessions()
-        now_datetime = datetime.now()
-        if sessions:
-            for day, times in sessions.items():
-                day_split = day.split('-')
-                year, month, day = int(day_split[0]), int(day_split[1]), int(day_split[2])
-                for time in times:
-                    user_id = int(time[2])
-                    if user_id != ADMIN_ID:
-                        time_split = time[1].split(':')
-                        hours, minutes, seconds = int(time_split[0]), int(time_split[1]), int(time_split[2])
-                        session_datetime = datetime(year, month, day, hours, minutes, seconds)
-                        delta = session_datetime - now_datetime
-                        if delta.days == 0:
-                            hours_to_session = int(str(delta).split(':')[0])
-                            if 21 <= hours_to_session <= 24:
-                                await bot.send_message(user_id, f"Just a reminder about your "
-                                                                f"session tomorrow at {time[1][:5]}")
-                                print(f'Send message to {user_id} about 24')
-
-                            elif 1 <= hours_to_session <= 4:
-                                await bot.send_message(user_id, f"I'll wait for you at {time[1][:5]}, "
-                                                                f"tell me if you're going to be late.")
-                                print(f'Send message to {user_id} about 3')
-        await asyncio.sleep(9300)
+    await reminder_scheduler.run(send_reminders)
 
 
-if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.create_task(user_reminder())
-    executor.start_polling(dp, skip_updates=True)
+async def janitor() -> None:
+    """Archives past sessions of every tenant every JANITOR_INTERVAL seconds"""
+    while True:
+        started = time.monotonic()
+        archived = 0
+        with metrics.loop_seconds.time('janitor'):
+            for tenant in tenants.all_tenants():
+                with tenants.use(tenant):
+                    try:
+                        archived += await async_db.refresh_db()
+                    except Exception as e:
+                        logging.exception('Janitor failed for %s: %r', tenant.key, e)
+        logging.info('Janitor archived %s sessions in %.3fs',
+                     archived, time.monotonic() - started)
+        await asyncio.sleep(JANITOR_INTERVAL)
+
+
+async def on_startup(dispatcher: Dispatcher) -> None:
+    if BOT_MODE == 'webhook' and WEBHOOK_HOST:
+        for tenant in tenants.all_tenants():
+            await tenant_bot(tenant).set_webhook(
+                f"{WEBHOOK_HOST}/webhook/{webhook_secret(tenant)}")
+    if METRICS_PORT:
+        await metrics.serve(METRICS_HOST, METRICS_PORT)
+    asyncio.create_task(user_reminder())
+    asyncio.create_task(janitor())
+    asyncio.create_task(hold_keeper.run())
+    asyncio.create_task(outbox_worker.run())
+
+
+class TenantWebhookHandler(WebhookRequestHandler):
+    """Hands the update to the bot of the tenant the path belongs to"""
+
+    def get_dispatcher(self):
+        dispatcher = super().get_dispatcher()
+        tenant = _webhook_tenants.get(self.request.match_info['secret'])
+        if tenant is None:
+            raise web.HTTPNotFound()
+        Bot.set_current(tenant_bot(tenant))
+        return dispatcher
+
+
+_webhook_tenants = {webhook_secret(tenant): tenant for tenant in tenants.all_tenants()}
+
+
+async def calendar_feed(request: web.Request) -> web.Response:
+    """GET of an .ics feed, 304 when the If-None-Match ETag is current"""
+    tenant = tenants.get(request.match_info['tenant'])
+    owner = request.match_info['owner']
+    if tenant is None or not (owner == 'master' or owner.isdigit()) or not hmac.compare_digest(
+            request.match_info['signature'], ical.feed_signature(tenant, owner)):
+        raise web.HTTPNotFound()
+    with tenants.use(tenant):
+        if owner == 'master':
+            feed = await async_db.master_feed()
+        else:
+            feed = await async_db.client_feed(int(owner))
+    headers = {'ETag': feed.etag, 'Cache-Control': 'private, max-age=300'}
+    if feed.etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=feed.body, headers=headers, content_type='text/calendar',
+                        charset='utf-8')
+
 
+def create_web_app() -> web.Application:
+    """aiohttp application of the webhook mode"""
+    app = web.Application()
+    app.router.add_get('/calendar/{tenant}/{owner}/{signature}.ics', calendar_feed)
+    return app
 
 
+def run_webhook() -> None:
+    """Serves the updates that Telegram POSTs to /webhook/<secret>,
+    one secret per tenant. Without WEBHOOK_HOST the webhooks are not
+    registered with Telegram, which is handy for POSTing recorded
+    updates locally."""
+    webhook_executor = executor.Executor(dp)
+    webhook_executor.on_startup(on_startup, polling=False)
+    webhook_executor.set_webhook('/webhook/{secret}', request_handler=TenantWebhookHandler,
+                                 web_app=create_web_app())
+    webhook_executor.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
 
 
+if __name__ == '__main__':
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    elif len(tenants.all_tenants()) > 1:
+        raise SystemExit('Several tenants can only be served in webhook mode')
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
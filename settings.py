@@ -0,0 +1,52 @@
+"""In-process cache of the master's settings: about, address and prices.
+
+Every update of the about row increments about.version. The cache is
+dropped by the writers of this process, and changes made by other
+processes sharing the database are noticed by comparing the version,
+which is checked at most every CHECK_INTERVAL seconds."""
+
+import threading
+import time
+from typing import NamedTuple, Optional
+
+import db
+
+CHECK_INTERVAL = 5.0
+
+
+class Settings(NamedTuple):
+    """Structure of the about row"""
+    price1: int
+    price2: int
+    price3: int
+    raw_address: str
+    about_master: str
+    version: int
+
+
+class SettingsCache:
+    def __init__(self, check_interval: float = CHECK_INTERVAL):
+        self._check_interval = check_interval
+        self._settings: Optional[Settings] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Settings:
+        settings = self._settings
+        if settings is not None and time.monotonic() - self._checked < self._check_interval:
+            return settings
+        with self._lock:
+            with db.read_connection() as conn:
+                if self._settings is not None:
+                    version = conn.execute("SELECT version FROM about").fetchone()[0]
+                    if version == self._settings.version:
+                        self._checked = time.monotonic()
+                        return self._settings
+                self._settings = Settings(*conn.execute(
+                    "SELECT price1, price2, price3, raw_address, about_master, version "
+                    "FROM about").fetchone())
+            self._checked = time.monotonic()
+            return self._settings
+
+    def invalidate(self) -> None:
+        self._settings = None
@@ -0,0 +1,105 @@
+"""Admin stats of the sessions.
+
+Counts of the sessions opened, booked, cancelled and deleted are kept per
+day and hour of the session in the stats table. db.py updates them in the
+transaction of every change, so a report reads one row per day and hour
+of its range however long the history is."""
+
+import calendar
+import datetime
+from collections import Counter
+from typing import NamedTuple, Tuple
+
+import clock
+import db
+import exceptions
+
+# days before and after today of the report without dates
+DEFAULT_DAYS = 30
+BUSIEST_HOURS = 3
+
+
+class Stats(NamedTuple):
+    first_day: datetime.date
+    last_day: datetime.date
+    opened: int
+    booked: int
+    cancelled: int
+    deleted: int
+    # weekday (0 is Monday) -> bookings
+    booked_by_weekday: dict
+    # hour -> bookings
+    booked_by_hour: dict
+
+
+def parse_range(args: str) -> Tuple[datetime.date, datetime.date]:
+    """Days of '/stats [first [last]]', dates are DD.MM or DD.MM.YYYY.
+    Without dates it's DEFAULT_DAYS before and after today,
+    with one date it's that day."""
+    dates = args.split()
+    today = clock.now().date()
+    if not dates:
+        return (today - datetime.timedelta(days=DEFAULT_DAYS),
+                today + datetime.timedelta(days=DEFAULT_DAYS))
+    if len(dates) > 2:
+        raise exceptions.NotCorrectMessage(_USAGE)
+    first_day = _parse_date(dates[0], today)
+    last_day = _parse_date(dates[-1], today)
+    if last_day < first_day:
+        raise exceptions.NotCorrectMessage(_USAGE)
+    return first_day, last_day
+
+
+_USAGE = ("Write /stats, or /stats with the first and the last day, "
+          "for example: /stats 01.04 30.04 or /stats 01.04.2026 30.04.2026")
+
+
+def _parse_date(text: str, today: datetime.date) -> datetime.date:
+    try:
+        parts = [int(part) for part in text.split('.')]
+        if len(parts) == 2:
+            return datetime.date(today.year, parts[1], parts[0])
+        if len(parts) == 3:
+            return datetime.date(parts[2], parts[1], parts[0])
+    except ValueError:
+        pass
+    raise exceptions.NotCorrectMessage(_USAGE)
+
+
+def get_stats(first_day: datetime.date, last_day: datetime.date) -> Stats:
+    opened = booked = cancelled = deleted = 0
+    by_weekday, by_hour = Counter(), Counter()
+    for day, hour, day_opened, day_booked, day_cancelled, day_deleted in db.get_stats(
+            str(first_day), str(last_day)):
+        opened += day_opened
+        booked += day_booked
+        cancelled += day_cancelled
+        deleted += day_deleted
+        by_weekday[datetime.date.fromisoformat(day).weekday()] += day_booked
+        by_hour[hour] += day_booked
+    return Stats(first_day, last_day, opened, booked, cancelled, deleted,
+                 dict(by_weekday), dict(by_hour))
+
+
+def report(args: str) -> str:
+    """Text of the /stats answer"""
+    stats = get_stats(*parse_range(args))
+    lines = [f"<b>Stats {stats.first_day:%d.%m.%Y} - {stats.last_day:%d.%m.%Y}</b>\n",
+             f"Sessions opened: {stats.opened}",
+             f"Bookings: {stats.booked}",
+             f"Cancelled: {stats.cancelled} ({_percent(stats.cancelled, stats.booked)} of bookings)",
+             f"Deleted: {stats.deleted}",
+             f"Utilisation: {_percent(stats.booked - stats.cancelled, stats.opened)} "
+             f"of the opened sessions booked and not cancelled"]
+    if stats.booked:
+        lines.append("\n<b>Bookings by weekday</b>")
+        lines.extend(f"{calendar.day_abbr[weekday]}: {stats.booked_by_weekday.get(weekday, 0)}"
+                     for weekday in range(7))
+        busiest = sorted(stats.booked_by_hour.items(), key=lambda item: (-item[1], item[0]))
+        lines.append("\n<b>Busiest hours</b>")
+        lines.extend(f"{hour:02}:00: {count}" for hour, count in busiest[:BUSIEST_HOURS] if count)
+    return "\n".join(lines)
+
+
+def _percent(part: int, whole: int) -> str:
+    return f"{part / whole:.0%}" if whole else "-"
@@ -0,0 +1,63 @@
+"""Background loop that serves all tenants.
+
+A subclass does the work of one tenant in visit(), which returns when the
+tenant is due again, or None when it has nothing pending. The loop keeps
+these times and visits only the tenants that are due, or that were woken
+by a write. Every tenant is visited once at startup, after that idle
+tenants aren't opened."""
+
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+
+import clock
+import metrics
+import tenants
+
+
+class TenantLoop:
+    def __init__(self, label: str, interval: int):
+        # label of the loop in metrics.loop_seconds
+        self.label = label
+        # longest wait between two rounds, and the delay after a failed visit
+        self.interval = interval
+        self._wake = asyncio.Event()
+        # tenant key -> when it's due
+        self._due: Dict[str, int] = {}
+        self._woken: Set[str] = set()
+
+    def wake(self) -> None:
+        """Visits the current tenant in the next round"""
+        self._woken.add(tenants.current().key)
+        self._wake.set()
+
+    async def visit(self) -> Optional[int]:
+        """Does the work of the current tenant, returns when it's due again"""
+        raise NotImplementedError
+
+    async def run(self) -> None:
+        self._woken.update(tenant.key for tenant in tenants.all_tenants())
+        while True:
+            self._wake.clear()
+            now = clock.now_epoch()
+            due_keys = self._woken | {key for key, due in self._due.items() if due <= now}
+            self._woken.clear()
+            for tenant_key in due_keys:
+                with tenants.use(tenants.get(tenant_key)), metrics.loop_seconds.time(self.label):
+                    try:
+                        due = await self.visit()
+                    except Exception as e:
+                        logging.exception('The %s loop failed for %s: %r',
+                                          self.label, tenant_key, e)
+                        due = now + self.interval
+                if due is None:
+                    self._due.pop(tenant_key, None)
+                else:
+                    self._due[tenant_key] = due
+            timeout = self.interval
+            if self._due:
+                timeout = min(timeout, max(min(self._due.values()) - clock.now_epoch(), 0))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,169 @@
+"""Tenants: the masters served by this process.
+
+Every master has their own bot, admin and SQLite file. The registry is read
+from the JSON file in TENANTS_FILE, a list of objects with "key", "token",
+"admin_id" and optionally "db_path" (db/<key>.db by default). Without the
+file the process serves one master configured by API_TOKEN and ADMIN_ID.
+
+The tenant of the update being handled is kept in a context variable, so
+db.py and appointment.py work on its shard without passing it around.
+Per-tenant objects (connections, the availability index, caches) are
+created on first use and kept for at most MAX_OPEN_TENANTS tenants; the
+least recently used tenant that is not in use is closed when there are more."""
+
+import json
+import os
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+DB_PATH = os.path.join("db", "appointment.db")
+MAX_OPEN_TENANTS = int(os.getenv("MAX_OPEN_TENANTS", 32))
+
+
+class Tenant(NamedTuple):
+    """Structure of a registry entry"""
+    key: str
+    token: str
+    admin_id: int
+    db_path: str
+
+
+def _load() -> Dict[str, Tenant]:
+    tenants_file = os.getenv("TENANTS_FILE")
+    if not tenants_file:
+        return {"default": Tenant("default", os.getenv("API_TOKEN"),
+                                  int(os.getenv("ADMIN_ID") or 0), DB_PATH)}
+    with open(tenants_file, "r") as f:
+        entries = json.load(f)
+    return OrderedDict(
+        (entry["key"], Tenant(entry["key"], entry["token"], int(entry["admin_id"]),
+                              entry.get("db_path") or os.path.join("db", f"{entry['key']}.db")))
+        for entry in entries)
+
+
+_registry = _load()
+
+_current: ContextVar[Optional[Tenant]] = ContextVar("tenant", default=None)
+
+
+def all_tenants() -> List[Tenant]:
+    return list(_registry.values())
+
+
+def get(key: str) -> Optional[Tenant]:
+    return _registry.get(key)
+
+
+def current() -> Tenant:
+    """The tenant of this context. A process with one tenant
+    doesn't need to set it."""
+    tenant = _current.get()
+    if tenant is None:
+        if len(_registry) != 1:
+            raise RuntimeError("No tenant in this context")
+        tenant = next(iter(_registry.values()))
+    return tenant
+
+
+def activate(tenant: Tenant) -> Token:
+    """Makes the tenant current and keeps it open until deactivate()"""
+    with _lock:
+        _active[tenant.key] += 1
+    return _current.set(tenant)
+
+
+def deactivate(token: Token) -> None:
+    tenant = _current.get()
+    _current.reset(token)
+    with _lock:
+        _active[tenant.key] -= 1
+        if _active[tenant.key] <= 0:
+            del _active[tenant.key]
+
+
+@contextmanager
+def use(tenant: Tenant):
+    token = activate(tenant)
+    try:
+        yield tenant
+    finally:
+        deactivate(token)
+
+
+# tenant key -> {resource: object} of the open tenants, least recently used first
+_open: "OrderedDict[str, Dict[TenantResource, Any]]" = OrderedDict()
+# tenant key -> number of contexts using the tenant now
+_active = Counter()
+# (tenant key, resource) -> lock of the object being made
+_building: "Dict[Tuple[str, TenantResource], threading.Lock]" = {}
+# guards the three above, never held while an object is made
+_lock = threading.RLock()
+
+
+class TenantResource:
+    """An object per tenant, made by factory(tenant) on first use.
+    If it has a close() method, it's called when the tenant is closed.
+    Objects are made outside the registry lock, so opening a tenant,
+    which can take a while, doesn't hold up the others."""
+
+    def __init__(self, factory: Callable[[Tenant], Any]):
+        self._factory = factory
+
+    def get(self) -> Any:
+        tenant = current()
+        with _lock:
+            resource = self._lookup(tenant.key)
+            if resource is not None:
+                return resource
+            building = _building.setdefault((tenant.key, self), threading.Lock())
+        with building:
+            with _lock:
+                # made by another thread while this one waited
+                resource = self._lookup(tenant.key)
+            if resource is not None:
+                return resource
+            try:
+                resource = self._factory(tenant)
+            except BaseException:
+                with _lock:
+                    _building.pop((tenant.key, self), None)
+                raise
+            with _lock:
+                resources = _open.get(tenant.key)
+                if resources is None:
+                    resources = _open[tenant.key] = {}
+                    _close_idle(keep=tenant.key)
+                resources[self] = resource
+                _building.pop((tenant.key, self), None)
+            return resource
+
+    def _lookup(self, key: str) -> Optional[Any]:
+        """The object of the tenant, marks the tenant as used. Under _lock"""
+        resources = _open.get(key)
+        if resources is None:
+            return None
+        _open.move_to_end(key)
+        return resources.get(self)
+
+    def peek(self) -> Optional[Any]:
+        """The object of the current tenant if it's made already"""
+        with _lock:
+            return _open.get(current().key, {}).get(self)
+
+
+def _close_idle(keep: str) -> None:
+    """Closes the least recently used tenants that are not in use
+    until at most MAX_OPEN_TENANTS are open"""
+    for key in list(_open):
+        if len(_open) <= MAX_OPEN_TENANTS:
+            break
+        if key == keep or _active[key] > 0:
+            continue
+        for resource in _open.pop(key).values():
+            close = getattr(resource, "close", None)
+            if close is not None:
+                close()
+
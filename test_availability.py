@@ -0,0 +1,75 @@
+"""The in-memory index stays equal to the database through the write paths.
+Run with `python -m unittest` from this directory."""
+
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import appointment
+import clock
+import db
+import tenants
+
+CLIENT_IDS = (101, 102, 103, 104)
+
+
+class IndexConsistencyTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        tenant = tenants.Tenant("index", "", 1, os.path.join(self._dir.name, "index.db"))
+        self._token = tenants.activate(tenant)
+        today = clock.now().date()
+        self.days = [today + datetime.timedelta(days=days) for days in (2, 3, 4)]
+
+    def tearDown(self):
+        db._database.get().close()
+        tenants.deactivate(self._token)
+        self._dir.cleanup()
+
+    def assertConsistent(self, step: str):
+        self.assertEqual(appointment.check_index(), [], step)
+
+    def session_ids(self, day: datetime.date) -> list:
+        return [slot.id for slot in appointment.get_timeline_slots().get(str(day), [])]
+
+    def test_write_paths(self):
+        first, second, third = self.days
+        appointment.add_sessions(f"{first:%d.%m} 10 12\n{second:%d.%m} 10 12")
+        appointment.add_sessions(f"{third:%d.%m} 10 12")
+        self.assertConsistent("add")
+        booked, freed = self.session_ids(first)
+        appointment.booking_session(booked, CLIENT_IDS[0], "first", "First")
+        appointment.booking_session(freed, CLIENT_IDS[1], "second", "Second")
+        self.assertConsistent("book")
+
+        appointment.join_waitlist(CLIENT_IDS[2], f"{first:%d.%m}")
+        appointment.join_waitlist(CLIENT_IDS[3], f"{first:%d.%m}")
+        appointment.cancel_session(freed)
+        self.assertConsistent("cancel, the session is held")
+        self.assertIn(str(first), appointment.get_available_sessions(CLIENT_IDS[2]))
+        self.assertNotIn(str(first), appointment.get_available_sessions(CLIENT_IDS[3]) or {})
+
+        with mock.patch.object(clock, "now_epoch",
+                               return_value=clock.now_epoch() + db.WAITLIST_HOLD):
+            self.assertEqual(appointment.expire_holds()[0], 1)
+        self.assertConsistent("expire, the session is held for the next client")
+        self.assertIn(str(first), appointment.get_available_sessions(CLIENT_IDS[3]))
+        appointment.leave_waitlist(CLIENT_IDS[3])
+        self.assertConsistent("leave")
+
+        appointment.delete_session(self.session_ids(second)[0])
+        self.assertConsistent("delete")
+        appointment.delete_day(str(second))
+        self.assertConsistent("delete_day")
+
+        after_first = clock.TIMEZONE.localize(datetime.datetime.combine(first, datetime.time(11)))
+        with mock.patch.object(clock, "now", return_value=after_first):
+            self.assertEqual(appointment.refresh_db(), 1)
+        self.assertConsistent("archive")
+        self.assertEqual(len(self.session_ids(first)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+"""CSV export of a 100k sessions fixture, half of them archived.
+Run with `python -m unittest` from this directory."""
+
+import csv
+import datetime
+import io
+import os
+import tempfile
+import unittest
+
+import clock
+import db
+import export
+import tenants
+
+SESSIONS = 100000
+SESSIONS_PER_DAY = 10
+CLIENT_ID = 1000
+# usernames a spreadsheet would run as formulas
+FORMULAS = ("=1+1", "+1", "-1", "@SUM(A1)", "\tx", "\rx")
+
+
+def _rows(first_day: datetime.date, sessions: int, step: int) -> list:
+    """Sessions from first_day on, or back from it with step -1,
+    every second one booked"""
+    now = clock.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    for i in range(sessions):
+        day = first_day + datetime.timedelta(days=step * (i // SESSIONS_PER_DAY))
+        session_time = datetime.time(8 + i % SESSIONS_PER_DAY)
+        row = (str(day), str(session_time), clock.to_epoch(day, session_time), True,
+               None, None, None, None)
+        if i % 2:
+            row = row[:3] + (False, CLIENT_ID + i, FORMULAS[i // 2 % len(FORMULAS)],
+                             f"Client {i}", now)
+        rows.append(row)
+    return rows
+
+
+class ExportTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._dir = tempfile.TemporaryDirectory()
+        tenant = tenants.Tenant("export", "", 1, os.path.join(cls._dir.name, "export.db"))
+        cls._token = tenants.activate(tenant)
+        today = clock.now().date()
+        cls.first_day = today + datetime.timedelta(days=1)
+        for rows in (_rows(today - datetime.timedelta(days=1), SESSIONS // 2, -1),
+                     _rows(cls.first_day, SESSIONS - SESSIONS // 2, 1)):
+            with db.write_connection() as conn:
+                conn.executemany(
+                    "INSERT INTO timeline (session_date, session_time, session_start, "
+                    "available, customer_user_id, customer_username, customer_name, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            # the past half goes to the archive
+            db.archive_past_sessions(clock.now_epoch())
+
+    @classmethod
+    def tearDownClass(cls):
+        db._database.get().close()
+        tenants.deactivate(cls._token)
+        cls._dir.cleanup()
+
+    def export(self, args: str):
+        """The file name, the count export() returned and the CSV rows"""
+        file, name, count = export.export(args)
+        with file:
+            rows = list(csv.reader(io.TextIOWrapper(file, encoding="utf-8-sig", newline="")))
+        return name, count, rows
+
+    def test_every_session_exported(self):
+        name, count, rows = self.export("")
+        self.assertEqual(name, "sessions.csv")
+        self.assertEqual(rows[0], list(export.HEADER))
+        self.assertEqual(count, SESSIONS)
+        self.assertEqual(len(rows) - 1, SESSIONS)
+        archived = [row for row in rows[1:] if row[9]]
+        self.assertEqual(len(archived), SESSIONS // 2)
+        self.assertEqual(len({(row[0], bool(row[9])) for row in rows[1:]}), SESSIONS)
+        booked = [row for row in rows[1:] if row[3] == "booked"]
+        self.assertEqual(len(booked), SESSIONS // 2)
+
+    def test_formulas_escaped(self):
+        _, _, rows = self.export("")
+        usernames = {row[5] for row in rows[1:] if row[3] == "booked"}
+        self.assertEqual(usernames, {"'" + formula for formula in FORMULAS})
+
+    def test_date_range(self):
+        day = f"{self.first_day:%d.%m.%Y}"
+        name, count, rows = self.export(f"{day} {day}")
+        self.assertEqual(name, f"sessions-{self.first_day:%Y%m%d}-{self.first_day:%Y%m%d}.csv")
+        self.assertEqual(count, SESSIONS_PER_DAY)
+        self.assertEqual({row[1] for row in rows[1:]}, {str(self.first_day)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+"""EXPLAIN QUERY PLAN of the statements on the hot paths.
+
+Every statement that a hot path runs is captured and its plan checked:
+no table is scanned, and the statements listed in a test use the index
+meant for them. Run with `python -m unittest` from this directory."""
+
+import datetime
+import os
+import tempfile
+import unittest
+from typing import Dict, List
+from unittest import mock
+
+import appointment
+import clock
+import db
+import tenants
+
+DAYS = 3
+SESSIONS_PER_DAY = 4
+USER_ID = 100
+
+
+# tables of a single row
+SINGLE_ROW_TABLES = ("changes",)
+
+
+def _is_scan(detail: str) -> bool:
+    """A full scan of a table or an index, json_each is a table-valued function"""
+    return (detail.startswith("SCAN ") and "VIRTUAL TABLE" not in detail
+            and detail.split()[1] not in SINGLE_ROW_TABLES)
+
+
+class QueryPlanTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._dir = tempfile.TemporaryDirectory()
+        tenant = tenants.Tenant("plans", "", 1, os.path.join(cls._dir.name, "plans.db"))
+        cls._token = tenants.activate(tenant)
+        first_day = clock.now().date() + datetime.timedelta(days=1)
+        rows = []
+        for day in range(DAYS):
+            session_date = first_day + datetime.timedelta(days=day)
+            for hour in range(SESSIONS_PER_DAY):
+                session_time = datetime.time(10 + hour)
+                rows.append({"session_date": str(session_date), "session_time": str(session_time),
+                             "session_start": clock.to_epoch(session_date, session_time),
+                             "available": True, "raw_text": "", "created": ""})
+        cls.session_ids = db.insert_sessions(rows)[0]
+        cls.days = sorted({row["session_date"] for row in rows})
+
+    @classmethod
+    def tearDownClass(cls):
+        db._database.get().close()
+        tenants.deactivate(cls._token)
+        cls._dir.cleanup()
+
+    def plans(self, func, *args) -> Dict[str, List[str]]:
+        """Runs func, returns the query plans of the statements it ran"""
+        statements = []
+        record = db._Connection._record
+
+        def capture(conn, sql, parameters, elapsed):
+            statements.append((sql, parameters))
+            record(conn, sql, parameters, elapsed)
+
+        with mock.patch.object(db._Connection, "_record", capture):
+            func(*args)
+        return {" ".join(sql.split()): db.explain_query_plan(sql, parameters)
+                for sql, parameters in statements
+                if parameters is not None and db._statement_label(sql).split()[0] in db._EXPLAINED}
+
+    def assertSearches(self, plans: Dict[str, List[str]], indexes: Dict[str, str] = None):
+        """No statement scans a table, the statements that start with a
+        key of indexes use that index"""
+        self.assertTrue(plans)
+        for sql, plan in plans.items():
+            scans = [detail for detail in plan if _is_scan(detail)]
+            self.assertFalse(scans, f"{sql}\n{plan}")
+        for prefix, index in (indexes or {}).items():
+            matching = [sql for sql in plans if sql.startswith(prefix)]
+            self.assertTrue(matching, f"no statement starts with {prefix!r}")
+            for sql in matching:
+                self.assertTrue(any(index in detail for detail in plans[sql]),
+                                f"{sql}\n{plans[sql]}")
+
+    def test_insert_sessions(self):
+        start = clock.to_epoch(datetime.date.fromisoformat(self.days[0]), datetime.time(20))
+        plans = self.plans(db.insert_sessions, [
+            {"session_date": self.days[0], "session_time": "20:00:00", "session_start": start,
+             "available": True, "raw_text": "", "created": ""}])
+        self.assertSearches(plans, {
+            "SELECT session_start FROM timeline": "timeline_start_idx",
+        })
+
+    def test_booking_and_cancel(self):
+        session_id = self.session_ids[0]
+        plans = self.plans(db.booking, session_id, USER_ID, "user", "User", "")
+        self.assertSearches(plans, {
+            "UPDATE timeline": "INTEGER PRIMARY KEY",
+            "SELECT id, due_at FROM reminders": "reminders_session_idx",
+            "DELETE FROM waitlist WHERE user_id=?": "waitlist_user_idx",
+        })
+        plans = self.plans(db.reset_session, session_id)
+        self.assertSearches(plans, {
+            "DELETE FROM reminders": "reminders_session_idx",
+            "UPDATE timeline": "INTEGER PRIMARY KEY",
+        })
+
+    def test_delete(self):
+        plans = self.plans(db.delete_session, self.session_ids[1])
+        self.assertSearches(plans, {
+            "DELETE FROM timeline": "INTEGER PRIMARY KEY",
+        })
+        plans = self.plans(db.delete_day, self.days[-1])
+        self.assertSearches(plans, {
+            "DELETE FROM timeline": "timeline_date_idx",
+            "DELETE FROM reminders": "reminders_session_idx",
+        })
+
+    def test_waitlist(self):
+        self.assertSearches(self.plans(db.join_waitlist, USER_ID + 1, self.days[0]))
+        # the freed session is offered to the client, then the hold lapses
+        plans = self.plans(db.reset_session, self.session_ids[2])
+        self.assertSearches(plans, {
+            "SELECT id, user_id FROM waitlist WHERE day=?": "waitlist_queue_idx",
+            "SELECT id, user_id FROM waitlist WHERE day IS NULL": "waitlist_queue_idx",
+        })
+        plans = self.plans(db.expire_holds, clock.now_epoch() + db.WAITLIST_HOLD)
+        self.assertSearches(plans, {
+            "SELECT holds.session_id": "holds_expires_idx",
+            "SELECT min(expires) FROM holds": "holds_expires_idx",
+        })
+        self.assertSearches(self.plans(db.leave_waitlist, USER_ID + 1), {
+            "SELECT session_id FROM holds": "holds_user_idx",
+        })
+
+    def test_reminders(self):
+        plans = self.plans(appointment.get_pending_reminders)
+        self.assertSearches(plans, {
+            "SELECT due_at, id FROM reminders": "reminders_due_idx",
+        })
+        self.assertSearches(self.plans(appointment.take_reminder, 1))
+
+    def test_outbox(self):
+        now = clock.now_epoch()
+        plans = self.plans(db.claim_outbox, now, 10, 60)
+        self.assertSearches(plans, {
+            "SELECT id, chat_id, text, attempts FROM outbox": "outbox_next_attempt_idx",
+        })
+        self.assertSearches(self.plans(db.next_outbox_attempt), {
+            "SELECT min(next_attempt) FROM outbox": "outbox_next_attempt_idx",
+        })
+
+    def test_stats_and_export(self):
+        self.assertSearches(self.plans(db.get_stats, self.days[0], self.days[-1]), {
+            "SELECT day, hour": "sqlite_autoindex_stats_1",
+        })
+        plans = self.plans(lambda: list(db.iter_sessions(0, 2 ** 62)))
+        self.assertSearches(plans, {
+            "SELECT id, session_date, session_time, available, customer_user_id, "
+            "customer_username, customer_name, updated, created, archived":
+                "timeline_archive_start_idx",
+            "SELECT id, session_date, session_time, available, customer_user_id, "
+            "customer_username, customer_name, updated, created, NULL": "timeline_start_idx",
+        })
+
+    def test_unused_indexes_dropped(self):
+        with db.read_connection() as read_conn:
+            indexes = {name for name, in read_conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='index'")}
+        self.assertFalse(indexes & {"timeline_available_idx", "timeline_customer_idx",
+                                    "timeline_available_start_idx"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Reminder scheduler against a database of a temporary tenant.
+Run with `python -m unittest` from this directory."""
+
+import asyncio
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import appointment
+import clock
+import db
+import reminders
+import tenants
+
+USER_ID = 100
+
+
+class ReminderSchedulerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._dir = tempfile.TemporaryDirectory()
+        tenant = tenants.Tenant("reminders", "", 1, os.path.join(cls._dir.name, "reminders.db"))
+        # the scheduler looks its entries' tenant up in the registry
+        cls._registry = mock.patch.dict(tenants._registry, {tenant.key: tenant})
+        cls._registry.start()
+        cls._token = tenants.activate(tenant)
+        rows = []
+        for days in (3, 5):
+            session_date = clock.now().date() + datetime.timedelta(days=days)
+            rows.append({"session_date": str(session_date), "session_time": "10:00:00",
+                         "session_start": clock.to_epoch(session_date, datetime.time(10)),
+                         "available": True, "raw_text": "", "created": ""})
+        cls.session_ids = db.insert_sessions(rows)[0]
+        cls.starts = [row["session_start"] for row in rows]
+
+    @classmethod
+    def tearDownClass(cls):
+        db._database.get().close()
+        tenants.deactivate(cls._token)
+        cls._registry.stop()
+        cls._dir.cleanup()
+
+    def run_due(self, scheduler: reminders.ReminderScheduler, now: int) -> list:
+        sent = []
+
+        async def send(due):
+            sent.extend(due)
+
+        with mock.patch.object(clock, "now_epoch", return_value=now):
+            asyncio.run(scheduler.run_due(send))
+        return sent
+
+    def test_cancelled_reminder_does_not_claim_a_new_one(self):
+        first, second = self.session_ids
+        scheduler = reminders.ReminderScheduler()
+        scheduler.add(appointment.booking_session(first, USER_ID, "user", "User"))
+        appointment.cancel_session(first)
+        scheduler.add(appointment.booking_session(second, USER_ID, "user", "User"))
+        day = dict(db.REMINDERS)["day"]
+        self.assertEqual(self.run_due(scheduler, self.starts[0] - day), [])
+        sent = self.run_due(scheduler, self.starts[1] - day)
+        self.assertEqual([(reminder.user_id, reminder.kind) for reminder in sent],
+                         [(USER_ID, "day")])
+
+
+if __name__ == "__main__":
+    unittest.main()